@@ -22,29 +22,163 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 ## the Representation and Token classes   ##
 ############################################
 
-import random
 import os
+import numpy as np
 
 # For vowel simulations
 # from representation_class import  Representation
 
-from representation_token_class import Representation, Token
+from representation_token_class import Representation, Token, spawn_rngs
+
+
+# Width of the confidence interval of the trend in converged(), in standard errors
+CONVERGENCE_Z = 2.0
+
+
+def drift(trajectory, window, target=None):
+    """
+    Trend of the last 2 * window productions (least-squares slope, scaled to one window)
+    :param trajectory: List of produced tokens (class: Token), oldest first
+    :param window: Number of tokens per window
+    :param target: Optional token (class: Token): the trend of the distance to it
+    :return: Pair of arrays (change per window, its standard error),
+             one element per dimension (sorted by name), or one for the distance to target
+    """
+    recent = trajectory[-max(2 * window, 3):]
+    dim_names = sorted(recent[-1].dimensions.keys())
+    values = np.asarray([[t.dimensions[dim] for dim in dim_names] for t in recent], dtype=np.float64)
+    if target is not None:
+        target_values = np.asarray([target.dimensions[dim] for dim in dim_names], dtype=np.float64)
+        values = np.sqrt(((values - target_values) ** 2).sum(axis=1, keepdims=True))
+
+    steps = np.arange(len(values)) - (len(values) - 1) / 2
+    centered = values - values.mean(axis=0)
+    slopes = steps @ centered / (steps ** 2).sum()
+    residuals = centered - np.outer(steps, slopes)
+    slope_se = np.sqrt((residuals ** 2).sum(axis=0) / (len(values) - 2) / (steps ** 2).sum())
+
+    return slopes * window, slope_se * window
+
+
+def converged(trajectory, window=5, tol=1.0, target=None):
+    """
+    Checks whether a production trajectory has plateaued: the trend of the last 2 * window
+    productions has to be below tol per window, even at the upper end of its
+    confidence interval (CONVERGENCE_Z standard errors), so that production noise
+    doesn't pass for a plateau. With noisy productions, short windows can't rule out
+    a trend of tol: use longer windows or a larger tol.
+    With a target token (e.g. the interlocutor's token), the trend of the distance
+    to the target is tested instead.
+    :param trajectory: List of produced tokens (class: Token), oldest first
+    :param window: Number of tokens per window
+    :param tol: Convergence tolerance, change per window in the units of the dimensions
+    :param target: Optional token (class: Token) to measure the distance to
+    :return: True if converged (boolean)
+    """
+    if len(trajectory) < max(2 * window, 3):
+        return False
+
+    change, change_se = drift(trajectory, window, target)
+    return float(np.linalg.norm(np.abs(change) + CONVERGENCE_Z * change_se)) < tol
+
+
+def shadow(speaker_cat, speaker_reps, i_token, n_act=100, max_iter=20,
+           window=5, tol=None, target=None, dims=None):
+    """
+    Shadowing task: the speaker hears the interlocutor's token and produces one of their own,
+    repeatedly, until the production trajectory converges or max_iter is reached
+    :param speaker_cat: Speaker's representation of the stimulus category (class: Representation)
+    :param speaker_reps: Speaker's representation of all categories (class: Representation)
+    :param i_token: Interlocutor's token (class: Token)
+    :param n_act: Number of tokens activated by each incoming token
+    :param max_iter: Maximum number of iterations
+    :param window: Window size of the convergence criterion (see converged())
+    :param tol: Convergence tolerance; if None, all max_iter iterations are run
+    :param target: Optional token for a distance-to-target convergence criterion
+    :param dims: Dimension(s) the Bayesian probabilities are calculated over, jointly
+                 (defaults to all dimensions of the speaker's representations)
+    :return: List of tokens produced by the speaker (class: Token)
+    """
+    trajectory = []
+    for i in range(max_iter):
+        # Token from the Interlocutor activates the Speaker's representational categories
+        # Based on the Bayesian probability of the token belonging to the given category
+        m_i = speaker_reps.bayesian_prob(i_token, dims)
+        speaker_cat.activate_4(i_token, n_act, m_i)
+        speaker_cat.incorporate(i_token)
+        speaker_reps.incorporate(i_token)
+
+        # Speaker produces their own token based on the activation pattern
+        sp_token = speaker_cat.produce_new(i_token.label, starting_act=0.1)
+        # Token from Speaker further activates the Speaker's representational categories
+        m_sp = speaker_reps.bayesian_prob(sp_token, dims)
+        speaker_cat.activate_4(sp_token, n_act, m_sp)
+        speaker_cat.incorporate(sp_token)
+        speaker_reps.incorporate(sp_token)
+        trajectory.append(sp_token)
+        # Activation incrementally decreasing (fading) over time
+        #speaker_cat.deactivate_flex()
+
+        if tol is not None and converged(trajectory, window, tol, target):
+            break
+
+    return trajectory
+
+
+
+# Starting distributions of the speakers' representational categories (Szabó 2020)
+# Each category (label) is a list of components of the form (number of tokens, dimensions)
+SPEAKER_PROFILES = {
+    'F08': {'p': [(10000, [('VOT', 73.834, 19.932)])],
+            'b': [(7616, [('VOT', 13.993, 5.751)]),
+                  (2384, [('VOT', -89.980, 34.551)])]},
+}
+
+
+def build_speaker(profile, act=0.1, rng=None):
+    """
+    Sets up a speaker's baseline representational categories
+    :param profile: Name of a profile in SPEAKER_PROFILES, or a profile of the same form
+    :param act: Starting activation of tokens
+    :param rng: Random number generator (class: numpy.random.Generator), every component
+                gets its own stream spawned from it (defaults to a new, unseeded one)
+    :return: Dictionary of representations: one per category label,
+             and all categories combined under 'all'
+    """
+    if isinstance(profile, str):
+        profile = SPEAKER_PROFILES[profile]
+    if rng is None:
+        rng = np.random.default_rng()
+    rngs = iter(spawn_rngs(rng, sum(len(components) for components in profile.values())))
+
+    speaker = {}
+    for label, components in profile.items():
+        for n, dims in components:
+            component = Representation(n=n, dims=dims, act=act, label=label, rng=next(rngs))
+            component.populate()
+            if label in speaker:
+                speaker[label] = speaker[label].combine(component)
+            else:
+                speaker[label] = component
+
+    categories = list(speaker.values())
+    speaker['all'] = categories[0]
+    for category in categories[1:]:
+        speaker['all'] = speaker['all'].combine(category)
+
+    return speaker
 
 
 def main():
-    random.seed(1)
+    rng = np.random.default_rng(1)
 
     ## VOT simulation -- voiceless 'p' stimuli
     # Setting up the speaker's representational categories
     # (English, based on subject F08)
-    speaker_vless_asp = Representation(n=10000, dims=[('VOT', 73.834, 19.932)], act=0.1, label='p')
-    speaker_vless_asp.populate()
-    speaker_vd_no_asp = Representation(n=7616, dims=[('VOT', 13.993, 5.751)], act=0.1, label='b')
-    speaker_vd_no_asp.populate()
-    speaker_vd_prevved = Representation(n=2384, dims=[('VOT', -89.980, 34.551)], act=0.1, label='b')
-    speaker_vd_prevved.populate()
-    speaker_vd = speaker_vd_no_asp.combine(speaker_vd_prevved)
-    speaker_reps = speaker_vd.combine(speaker_vless_asp)
+    speaker = build_speaker('F08', rng=rng)
+    speaker_vless_asp = speaker['p']
+    speaker_vd = speaker['b']
+    speaker_reps = speaker['all']
 
 
     # Choosing stimulus (Interlocutor's token)
@@ -73,25 +207,9 @@ def main():
     speaker_vless_asp.activate_4(t0, 100, m0)
 
 
-    for i in range(20):
-        # Token from the Interlocutor activates the Speaker's representational categories
-        # Based on the Bayesian probability of the token belonging to the given category
-        m_i = speaker_reps.bayesian_prob(i_token, 'VOT')
-        # print(m_i)
-        speaker_vless_asp.activate_4(i_token, 100, m_i)
-        speaker_vless_asp.incorporate(i_token)
-        speaker_reps.incorporate(i_token)
-
-        # Speaker produces their own token based on the activation pattern
-        sp_token = speaker_vless_asp.produce_new(i_token.label, starting_act=0.1)
-        # Token from Speaker further activates the Speaker's representational categories
-        m_sp = speaker_reps.bayesian_prob(sp_token, 'VOT')
-        speaker_vless_asp.activate_4(sp_token, 100, m_sp)
-        speaker_vless_asp.incorporate(sp_token)
-        speaker_reps.incorporate(sp_token)
-        vless_production.append(str(sp_token.dimensions['VOT']))
-        # Activation incrementally decreasing (fading) over time
-        #speaker_vless_asp.deactivate_flex()
+    # Shadowing: 20 iterations
+    sp_tokens = shadow(speaker_vless_asp, speaker_reps, i_token, n_act=100, max_iter=20)
+    vless_production += [str(sp_token.dimensions['VOT']) for sp_token in sp_tokens]
 
 
     # Write productions to .txt file
@@ -110,11 +228,15 @@ def main():
 
     """
     ## Vowel simulation
-    male_front_low = Representation(n=150000, dims=[('F1', 6.5, 0.5), ('F2', 11.8, 0.5)], act=0.1)
+    male_rng, fem_rng, interloc_rng = spawn_rngs(rng, 3)
+    male_front_low = Representation(n=150000, dims=[('F1', 6.5, 0.5), ('F2', 11.8, 0.5)], act=0.1,
+                                    rng=male_rng)
     male_front_low.populate()
-    fem_front_low = Representation(n=150000, dims=[('F1', 8.2, 0.5), ('F2', 12.1, 0.5)], act=0.1)
+    fem_front_low = Representation(n=150000, dims=[('F1', 8.2, 0.5), ('F2', 12.1, 0.5)], act=0.1,
+                                   rng=fem_rng)
     fem_front_low.populate()
-    interloc_front_low = Representation(n=4000, dims=[('F1', 5.9, 0.1), ('F2', 11.2, 0.1)])
+    interloc_front_low = Representation(n=4000, dims=[('F1', 5.9, 0.1), ('F2', 11.2, 0.1)],
+                                        rng=interloc_rng)
     interloc_front_low.populate()
 
 
@@ -131,7 +253,7 @@ def main():
 
     # "Male" model
     for i in range(60):
-        token = random.choice(interloc_front_low)
+        token = rng.choice(interloc_front_low.all_tokens())
         male_front_low.activate_3(token, 200)
 
         # Comment out following line for dual-pool simulation
@@ -144,7 +266,7 @@ def main():
 
     # "Female" model
     for i in range(60):
-        token = random.choice(interloc_front_low)
+        token = rng.choice(interloc_front_low.all_tokens())
         fem_front_low.activate_3(token, 200)
 
         # Comment out following line for dual-pool simulation
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Array operations over large            ##
+## representations, split into chunks     ##
+## and run on a thread pool               ##
+############################################
+
+# numpy releases the GIL in these operations, so the chunks of one
+# representation are processed on several cores at the same time.
+# Arrays smaller than CHUNK_ROWS rows are processed on the calling thread.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+CHUNK_ROWS = 65536
+
+num_threads = os.cpu_count() or 1
+_executor = None
+
+
+def set_num_threads(n=None):
+    """
+    Sets the number of threads used for the chunks
+    :param n: Number of threads (defaults to the number of CPUs, 1 turns threading off)
+    :return: None
+    """
+    global num_threads, _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    num_threads = max(1, n or os.cpu_count() or 1)
+
+
+def chunk_slices(n):
+    """
+    :param n: Number of rows
+    :return: List of slices, one per chunk
+    """
+    if num_threads == 1 or n <= CHUNK_ROWS:
+        return [slice(0, n)]
+    size = max(CHUNK_ROWS, -(-n // num_threads))
+    return [slice(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def map_chunks(func, n):
+    """
+    Calls func on the chunks of n rows, on the thread pool
+    :param func: Function of a slice
+    :param n: Number of rows
+    :return: List of the return values of func, in the order of the chunks
+    """
+    global _executor
+    slices = chunk_slices(n)
+    if len(slices) == 1:
+        return [func(slices[0])]
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=num_threads)
+    return list(_executor.map(func, slices))
+
+
+def distances(metric, values, point):
+    """
+    Distances of many tokens from a point
+    :param metric: Distance between tokens (class: Metric)
+    :param values: Values of the tokens (array of shape (n, number of dimensions))
+    :param point: Array of values, aligned with metric.dims
+    :return: Array of n distances
+    """
+    out = np.empty(len(values))
+    if not metric.plain:
+        # computed once, before the threads share it
+        metric.transform()
+
+    def work(rows):
+        out[rows] = metric.distances(values[rows], point)
+
+    map_chunks(work, len(values))
+    return out
+
+
+def top_k(dists, k):
+    """
+    Indices of the k smallest distances: the k smallest of each chunk, then of their union
+    :param dists: Array of distances
+    :param k: Number of indices
+    :return: Array of indices, smallest distance first (ties broken by index)
+    """
+    k = min(k, len(dists))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+
+    def work(rows):
+        part = dists[rows]
+        if k < len(part):
+            return np.argpartition(part, k - 1)[:k] + rows.start
+        return np.arange(rows.start, rows.stop)
+
+    candidates = np.concatenate(map_chunks(work, len(dists)))
+    if k < len(candidates):
+        candidates = candidates[np.argpartition(dists[candidates], k - 1)[:k]]
+    return candidates[np.lexsort((candidates, dists[candidates]))]
+
+
+def weighted_sum(values, weights):
+    """
+    Weighted sum of the values of tokens
+    :param values: Values of the tokens (array of shape (n, number of dimensions))
+    :param weights: Array of n weights
+    :return: Pair of (array of weighted sums along each dimension, sum of the weights)
+    """
+    def work(rows):
+        return weights[rows] @ values[rows], weights[rows].sum()
+
+    results = map_chunks(work, len(values))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def deactivate(acts, amount):
+    """
+    Decreases activation levels by a fixed amount, with a floor of 0
+    :param acts: Array of activation levels
+    :param amount: Decrease to be implemented (a number, or an array aligned with acts)
+    :return: New array of activation levels
+    """
+    out = np.empty(len(acts))
+    amount = np.broadcast_to(amount, acts.shape)
+
+    def work(rows):
+        out[rows] = np.where(acts[rows] > amount[rows], acts[rows] - amount[rows], 0.0)
+
+    map_chunks(work, len(acts))
+    return out
+
+
+def kernel_sum(values, point, bandwidth):
+    """
+    Sum of (unnormalized) Gaussian kernels centered on tokens, at a point
+    :param values: Values of the tokens (array of shape (n, number of dimensions))
+    :param point: Array of values
+    :param bandwidth: Bandwidth of the kernel
+    :return: Sum (float)
+    """
+    def work(rows):
+        sq_dists = ((values[rows] - point) ** 2).sum(axis=1)
+        return np.exp(-0.5 * sq_dists / bandwidth ** 2).sum()
+
+    return float(sum(map_chunks(work, len(values))))
@@ -0,0 +1,1070 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Disk-backed storage of tokens for      ##
+## representations too big for memory     ##
+############################################
+
+# Tokens are stored in fixed-size chunks of memory-mapped .npy files
+# (values, activation levels and label codes), and every chunk has a summary
+# (count, min/max/sum/sum of squares per dimension, sum of outer products, and count, sum, sum of
+# outer products, total activation and activation-weighted sum of values per label) kept in meta.json.
+# Searches and density estimation skip the chunks that cannot matter based on their
+# summaries, and producing a new token only reads the summaries. For the summaries' ranges
+# to be narrow, populated tokens are written in spatial order (see partition_order()).
+# A DiskRepresentation reads one or more stores: combined and filtered representations read
+# the stores of the representations they were made of, and add their new tokens to their own.
+
+import json
+import math
+import os
+import shutil
+import statistics as stats
+import tempfile
+import weakref
+import numpy as np
+
+from representation_token_class import Metric, Representation, Token, spawn_rngs, vec_proportionate_inverse
+import chunked_kernels
+
+
+DEFAULT_CHUNK_SIZE = 1000000
+
+# Gaussian kernel contributions from beyond this many bandwidths are ignored
+KERNEL_CUTOFF = 8.0
+
+# Populated tokens are partitioned into chunks this many chunks' worth at a time
+PARTITION_CHUNKS = 16
+
+# Label code of the rows of removed tokens (see ChunkedTokenStore.forget_rows())
+REMOVED_CODE = -1
+
+
+def empty_summary(n_dims):
+    return {'count': 0,
+            'removed': 0,
+            'min': [math.inf] * n_dims,
+            'max': [-math.inf] * n_dims,
+            'sum': [0.0] * n_dims,
+            'sumsq': [0.0] * n_dims,
+            'outer': np.zeros((n_dims, n_dims)).tolist(),
+            'label_counts': {},
+            'label_sums': {},
+            'label_outer': {},
+            'label_act_totals': {},
+            'label_act_sums': {}}
+
+
+def summary_add_rows(summary, values, acts, labels):
+    """
+    Updates a chunk summary with new rows
+    :param summary: Chunk summary
+    :param values: Values of the new rows (array of shape (m, number of dimensions))
+    :param acts: Activation levels of the new rows
+    :param labels: Labels of the new rows (array of strings)
+    :return: None, changes summary in place
+    """
+    if len(values) == 0:
+        return
+    summary['count'] += len(values)
+    summary['min'] = np.minimum(summary['min'], values.min(axis=0)).tolist()
+    summary['max'] = np.maximum(summary['max'], values.max(axis=0)).tolist()
+    summary['sum'] = (np.asarray(summary['sum']) + values.sum(axis=0)).tolist()
+    summary['sumsq'] = (np.asarray(summary['sumsq']) + (values ** 2).sum(axis=0)).tolist()
+    summary['outer'] = (np.asarray(summary['outer']) + values.T @ values).tolist()
+    for label in np.unique(labels):
+        mask = labels == label
+        label = str(label)
+        summary['label_counts'][label] = summary['label_counts'].get(label, 0) + int(mask.sum())
+        old_sums = summary['label_sums'].get(label, [0.0] * values.shape[1])
+        summary['label_sums'][label] = (np.asarray(old_sums) + values[mask].sum(axis=0)).tolist()
+        old_outer = summary['label_outer'].get(label, np.zeros((values.shape[1], values.shape[1])))
+        summary['label_outer'][label] = (np.asarray(old_outer) + values[mask].T @ values[mask]).tolist()
+    summary_add_act(summary, values, acts, labels)
+
+
+def summary_remove_rows(summary, values, acts, labels):
+    """
+    Updates a chunk summary with removed rows (the chunk's range still includes them)
+    :param summary: Chunk summary
+    :param values: Values of the removed rows (array of shape (m, number of dimensions))
+    :param acts: Activation levels of the removed rows
+    :param labels: Labels of the removed rows (array of strings)
+    :return: None, changes summary in place
+    """
+    summary['removed'] = summary.get('removed', 0) + len(values)
+    summary['sum'] = (np.asarray(summary['sum']) - values.sum(axis=0)).tolist()
+    summary['sumsq'] = (np.asarray(summary['sumsq']) - (values ** 2).sum(axis=0)).tolist()
+    summary['outer'] = (np.asarray(summary['outer']) - values.T @ values).tolist()
+    for label in np.unique(labels):
+        mask = labels == label
+        label = str(label)
+        summary['label_counts'][label] -= int(mask.sum())
+        summary['label_sums'][label] = (np.asarray(summary['label_sums'][label]) -
+                                        values[mask].sum(axis=0)).tolist()
+        summary['label_outer'][label] = (np.asarray(summary['label_outer'][label]) -
+                                         values[mask].T @ values[mask]).tolist()
+    summary_add_act(summary, values, -acts, labels)
+
+
+def summary_add_act(summary, values, delta, labels):
+    """
+    Updates the activation totals of a chunk summary
+    :param summary: Chunk summary
+    :param values: Values of the rows whose activation changed
+    :param delta: Change of activation levels of the rows
+    :param labels: Labels of the rows (array of strings)
+    :return: None, changes summary in place
+    """
+    for label in np.unique(labels):
+        mask = labels == label
+        label = str(label)
+        summary['label_act_totals'][label] = summary['label_act_totals'].get(label, 0.0) + \
+            float(delta[mask].sum())
+        old_sums = summary['label_act_sums'].get(label, [0.0] * values.shape[1])
+        summary['label_act_sums'][label] = (np.asarray(old_sums) + delta[mask] @ values[mask]).tolist()
+
+
+def partition_order(values, size):
+    """
+    Order of rows that groups them into runs of size rows with small ranges along every dimension
+    (recursive splits of the rows along their widest dimension, at multiples of size)
+    :param values: Values of the rows (array of shape (n, number of dimensions))
+    :param size: Number of rows per run (the chunk size)
+    :return: Array of row indices
+    """
+    runs = []
+    stack = [np.arange(len(values))]
+    while stack:
+        rows = stack.pop()
+        if len(rows) <= size:
+            runs.append(rows)
+            continue
+        part_values = values[rows]
+        dim = int(np.argmax(part_values.max(axis=0) - part_values.min(axis=0)))
+        split = -(-len(rows) // (2 * size)) * size
+        order = np.argpartition(part_values[:, dim], split)
+        stack.append(rows[order[split:]])
+        stack.append(rows[order[:split]])
+    return np.concatenate(runs) if runs else np.empty(0, dtype=np.int64)
+
+
+def kernel_norm(bandwidth, n_dims):
+    """
+    :return: Normalization of a Gaussian kernel (as in sklearn.neighbors.KernelDensity)
+    """
+    return (2 * math.pi * bandwidth ** 2) ** (n_dims / 2)
+
+
+def copy_parts(parts, store):
+    """
+    Appends the tokens of one or more stores to another one, in spatial order
+    (PARTITION_CHUNKS chunks' worth at a time, see partition_order())
+    :param parts: List of pairs (store, label): the tokens of the store,
+                  only those of the label if it's not None
+    :param store: Store to append the tokens to
+    :return: None
+    """
+    batch = []
+    for part_store, label in parts:
+        for i in range(len(part_store.meta['chunks'])):
+            values, acts, codes = part_store.chunk_rows(i)
+            mask = part_store.row_mask(i, codes, label)
+            if mask is not None:
+                values, acts, codes = values[mask], acts[mask], codes[mask]
+            batch.append((np.array(values), np.array(acts), part_store.label_array()[codes]))
+            if sum(len(rows[0]) for rows in batch) >= PARTITION_CHUNKS * store.chunk_size:
+                store.append(*[np.concatenate(arrays) for arrays in zip(*batch)], partition=True)
+                batch = []
+    if batch:
+        store.append(*[np.concatenate(arrays) for arrays in zip(*batch)], partition=True)
+
+
+def release(store):
+    """
+    Stops a representation from reading a store, and closes the store if no representation reads it
+    :param store: ChunkedTokenStore
+    :return: None
+    """
+    store.users -= 1
+    if store.users == 0:
+        store.close()
+
+
+def box_distance(point, box_min, box_max):
+    """
+    Lower bound of the Euclidean distance between a point and any point in a box
+    :param point: Array of values
+    :param box_min: Minimum of the box along each dimension
+    :param box_max: Maximum of the box along each dimension
+    :return: Distance (float)
+    """
+    gaps = np.maximum(np.maximum(np.asarray(box_min) - point, point - np.asarray(box_max)), 0)
+    return float(np.sqrt((gaps ** 2).sum()))
+
+
+def nearest(parts, point, k, metric=None):
+    """
+    The k tokens closest to a point, in one or more stores. Chunks farther away than
+    the k-th closest token found so far are not read.
+    :param parts: List of pairs (store, label): the tokens of the store (class: ChunkedTokenStore),
+                  only those of the label if it's not None
+    :param point: Array of values along all dimensions
+    :param k: Number of tokens to find
+    :param metric: Distance between tokens (class: Metric, defaults to Euclidean distance)
+    :return: Quadruple of arrays (part indices, chunk indices, rows, distances), closest first
+    """
+    point = np.asarray(point, dtype=np.float64)
+    if metric is None:
+        metric = Metric(parts[0][0].dims)
+    bound_factor = metric.lower_bound_factor()
+    best = [np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)]
+    best_dists = np.empty(0, dtype=np.float64)
+
+    candidates = sorted((bound, p, i) for p, (store, label) in enumerate(parts)
+                        for bound, i in store.candidate_chunks(point, label=label))
+    for bound, p, i in candidates:
+        if len(best_dists) == k and bound * bound_factor > best_dists.max():
+            break
+        store, label = parts[p]
+        values, acts, codes = store.chunk_rows(i)
+        dists = chunked_kernels.distances(metric, values, point)
+        rows = np.arange(len(dists))
+        mask = store.row_mask(i, codes, label)
+        if mask is not None:
+            dists, rows = dists[mask], rows[mask]
+
+        best = [np.concatenate([best[0], np.full(len(rows), p)]),
+                np.concatenate([best[1], np.full(len(rows), i)]),
+                np.concatenate([best[2], rows])]
+        best_dists = np.concatenate([best_dists, dists])
+        if len(best_dists) > k:
+            keep = np.argpartition(best_dists, k - 1)[:k]
+            best, best_dists = [array[keep] for array in best], best_dists[keep]
+
+    order = np.argsort(best_dists, kind='stable')
+    return best[0][order], best[1][order], best[2][order], best_dists[order]
+
+
+class ChunkedTokenStore:
+    def __init__(self, path=None, dims=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Opens the store in the directory path, or creates a new one
+        Stores in a given directory write their summaries to meta.json after every change,
+        so that they can be reopened; temporary stores only do so when flushed.
+        :param path: Directory of the store (defaults to a new temporary directory,
+                     removed when the store is closed or garbage collected)
+        :param dims: List of dimension names (only needed for new stores)
+        :param chunk_size: Number of tokens per chunk (only used for new stores)
+        """
+        self.temporary = path is None
+        if self.temporary:
+            path = tempfile.mkdtemp(prefix='representation_')
+            self.remove = weakref.finalize(self, shutil.rmtree, path, ignore_errors=True)
+        self.path = path
+        # Number of representations reading the store (see DiskRepresentation.close())
+        self.users = 0
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as meta_f:
+                self.meta = json.load(meta_f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {'dims': list(dims), 'labels': [], 'chunk_size': chunk_size, 'chunks': []}
+        self.dims = self.meta['dims']
+        self.chunk_size = self.meta['chunk_size']
+        self.chunks = {}
+
+    def __len__(self):
+        return sum(self.chunk_count(i) for i in range(len(self.meta['chunks'])))
+
+    def close(self):
+        """
+        Writes the store to disk and closes its memory maps. Temporary stores are removed instead.
+        :return: None
+        """
+        if self.temporary:
+            self.chunks = {}
+            self.remove()
+        else:
+            self.flush()
+            self.chunks = {}
+
+    def count(self, label=None):
+        """
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Number of tokens
+        """
+        return sum(self.chunk_count(i, label) for i in range(len(self.meta['chunks'])))
+
+    def chunk_count(self, i, label=None):
+        """
+        :param i: Index of the chunk
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Number of tokens in the chunk (removed rows excluded)
+        """
+        summary = self.meta['chunks'][i]
+        if label is None:
+            return summary['count'] - summary.get('removed', 0)
+        return summary['label_counts'].get(label, 0)
+
+    def moments(self, label=None):
+        """
+        Computed from the chunk summaries
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Triplet (number of tokens, sum of values, sum of outer products of values)
+        """
+        n_dims = len(self.dims)
+        n, sums, outer = 0, np.zeros(n_dims), np.zeros((n_dims, n_dims))
+        for i, summary in enumerate(self.meta['chunks']):
+            if label is None:
+                n += self.chunk_count(i)
+                sums += summary['sum']
+                outer += summary['outer']
+            elif summary['label_counts'].get(label, 0) > 0:
+                n += summary['label_counts'][label]
+                sums += summary['label_sums'][label]
+                outer += summary['label_outer'][label]
+        return n, sums, outer
+
+    def flush(self):
+        """
+        Writes the memory-mapped chunks and the summaries to disk
+        :return: None
+        """
+        for values, acts, codes in self.chunks.values():
+            values.flush()
+            acts.flush()
+            codes.flush()
+        self.save_meta()
+
+    def save_meta(self):
+        """
+        Writes the summaries to disk
+        :return: None
+        """
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as meta_f:
+            json.dump(self.meta, meta_f)
+
+    def changed(self):
+        """
+        Called after every change: writes the summaries of stores that aren't temporary
+        (the memory-mapped chunks are written by the operating system, or by flush())
+        :return: None
+        """
+        if not self.temporary:
+            self.save_meta()
+
+    def chunk_file(self, i, kind):
+        return os.path.join(self.path, 'chunk_{:05d}_{}.npy'.format(i, kind))
+
+    def chunk(self, i):
+        """
+        Memory-maps a chunk (whole capacity, see chunk_rows() for the used rows)
+        :param i: Index of the chunk
+        :return: Triplet of arrays (values, activation levels, label codes)
+        """
+        if i not in self.chunks:
+            self.chunks[i] = tuple(np.load(self.chunk_file(i, kind), mmap_mode='r+')
+                                   for kind in ('values', 'acts', 'labels'))
+        return self.chunks[i]
+
+    def chunk_rows(self, i):
+        """
+        :param i: Index of the chunk
+        :return: Triplet of arrays (values, activation levels, label codes) of the used rows of the chunk
+        """
+        values, acts, codes = self.chunk(i)
+        count = self.meta['chunks'][i]['count']
+        return values[:count], acts[:count], codes[:count]
+
+    def row_mask(self, i, codes, label=None):
+        """
+        :param i: Index of the chunk
+        :param codes: Label codes of the used rows of the chunk (see chunk_rows())
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Boolean array of the rows holding tokens (of the label), None if every row does
+        """
+        if label is not None:
+            code = self.code_of(label)
+            if code is None:
+                return np.zeros(len(codes), dtype=bool)
+            return codes == code
+        if self.meta['chunks'][i].get('removed', 0) > 0:
+            return codes != REMOVED_CODE
+        return None
+
+    def label_array(self):
+        """
+        :return: Array of the labels, indexed by label code
+        """
+        return np.asarray(self.meta['labels'], dtype=object)
+
+    def code_of(self, label):
+        """
+        :param label: Label
+        :return: Code of the label (None if no token has this label)
+        """
+        if label in self.meta['labels']:
+            return self.meta['labels'].index(label)
+        return None
+
+    def new_chunk(self):
+        i = len(self.meta['chunks'])
+        shapes = {'values': ((self.chunk_size, len(self.dims)), np.float64),
+                  'acts': ((self.chunk_size,), np.float64),
+                  'labels': ((self.chunk_size,), np.int32)}
+        self.chunks[i] = tuple(np.lib.format.open_memmap(self.chunk_file(i, kind), mode='w+',
+                                                         dtype=dtype, shape=shape)
+                               for kind, (shape, dtype) in shapes.items())
+        self.meta['chunks'].append(empty_summary(len(self.dims)))
+        return i
+
+    def label_code(self, label):
+        if label not in self.meta['labels']:
+            self.meta['labels'].append(label)
+        return self.meta['labels'].index(label)
+
+    def append(self, values, acts, labels, partition=False):
+        """
+        Adds tokens to the store
+        :param values: Values of the tokens (array of shape (m, number of dimensions))
+        :param acts: Activation levels of the tokens
+        :param labels: Labels of the tokens
+        :param partition: Write the tokens in spatial order, starting with a new chunk
+                          (see partition_order())
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64).reshape((-1, len(self.dims)))
+        acts = np.asarray(acts, dtype=np.float64)
+        labels = np.asarray(labels, dtype=object)
+        if partition:
+            order = partition_order(values, self.chunk_size)
+            values, acts, labels = values[order], acts[order], labels[order]
+            if self.meta['chunks'] and 0 < self.meta['chunks'][-1]['count'] < self.chunk_size:
+                self.new_chunk()
+        codes = np.asarray([self.label_code(label) for label in labels], dtype=np.int32)
+
+        start = 0
+        while start < len(values):
+            if not self.meta['chunks'] or self.meta['chunks'][-1]['count'] == self.chunk_size:
+                self.new_chunk()
+            i = len(self.meta['chunks']) - 1
+            summary = self.meta['chunks'][i]
+            stop = min(len(values), start + self.chunk_size - summary['count'])
+            chunk_values, chunk_acts, chunk_codes = self.chunk(i)
+            rows = slice(summary['count'], summary['count'] + stop - start)
+            chunk_values[rows] = values[start:stop]
+            chunk_acts[rows] = acts[start:stop]
+            chunk_codes[rows] = codes[start:stop]
+            summary_add_rows(summary, values[start:stop], acts[start:stop], labels[start:stop])
+            start = stop
+        self.changed()
+
+    def candidate_chunks(self, point, dim_indices=None, label=None):
+        """
+        Chunks that contain tokens (of a label), in order of their lower bound distance from a point
+        :param point: Array of values along the dimensions in dim_indices
+        :param dim_indices: Indices of the dimensions to measure distance along (defaults to all)
+        :param label: Only chunks with tokens of this label (defaults to any label)
+        :return: List of pairs (lower bound distance, chunk index)
+        """
+        if dim_indices is None:
+            dim_indices = list(range(len(self.dims)))
+        candidates = []
+        for i, summary in enumerate(self.meta['chunks']):
+            if self.chunk_count(i, label) == 0:
+                continue
+            bound = box_distance(point, np.asarray(summary['min'])[dim_indices],
+                                 np.asarray(summary['max'])[dim_indices])
+            candidates.append((bound, i))
+        return sorted(candidates)
+
+    def nearest(self, point, k, label=None, metric=None):
+        """
+        The k tokens closest to a point (see nearest())
+        :param point: Array of values along all dimensions
+        :param k: Number of tokens to find
+        :param label: Only tokens of this label (defaults to any label)
+        :param metric: Distance between tokens (class: Metric, defaults to Euclidean distance)
+        :return: Triplet of arrays (chunk indices, rows, distances), closest first
+        """
+        parts, chunk_ids, rows, dists = nearest([(self, label)], point, k, metric)
+        return chunk_ids, rows, dists
+
+    def add_act(self, chunk_ids, rows, delta):
+        """
+        Increments the activation levels of tokens
+        :param chunk_ids: Chunk index of each token
+        :param rows: Row of each token within its chunk
+        :param delta: Increment for each token
+        :return: None
+        """
+        delta = np.asarray(delta, dtype=np.float64)
+        for i in np.unique(chunk_ids):
+            mask = chunk_ids == i
+            values, acts, codes = self.chunk_rows(i)
+            np.add.at(acts, rows[mask], delta[mask])
+            summary_add_act(self.meta['chunks'][i], values[rows[mask]], delta[mask],
+                            self.label_array()[codes[rows[mask]]])
+        self.changed()
+
+    def forget_rows(self, chunk_ids, rows):
+        """
+        Removes tokens: their rows are marked as removed (label code REMOVED_CODE),
+        and no longer count in the chunk summaries
+        :param chunk_ids: Chunk index of each token
+        :param rows: Row of each token within its chunk
+        :return: None
+        """
+        for i in np.unique(chunk_ids):
+            chunk_rows = rows[chunk_ids == i]
+            values, acts, codes = self.chunk_rows(i)
+            summary_remove_rows(self.meta['chunks'][i], values[chunk_rows], acts[chunk_rows],
+                                self.label_array()[codes[chunk_rows]])
+            acts[chunk_rows] = 0.0
+            codes[chunk_rows] = REMOVED_CODE
+        self.changed()
+
+    def update_acts(self, func, label=None):
+        """
+        Sets the activation levels of all activated tokens to func(activation levels),
+        chunks without activated tokens are not read
+        :param func: Function applied to an array of activation levels
+        :param label: Only tokens of this label (defaults to any label)
+        :return: None
+        """
+        for i, summary in enumerate(self.meta['chunks']):
+            if label is None and not any(summary['label_act_totals'].values()) or \
+                    label is not None and not summary['label_act_totals'].get(label, 0.0):
+                continue
+            values, acts, codes = self.chunk_rows(i)
+            mask = self.row_mask(i, codes, label)
+            if mask is None:
+                mask = slice(None)
+            acts[mask] = func(acts[mask])
+            if label is None:
+                summary['label_act_totals'] = {}
+                summary['label_act_sums'] = {}
+            else:
+                summary['label_act_totals'].pop(label)
+                summary['label_act_sums'].pop(label)
+            summary_add_act(summary, values[mask], acts[mask], self.label_array()[codes[mask]])
+        self.changed()
+
+    def min_nonzero_act(self, label=None):
+        """
+        :param label: Only tokens of this label (defaults to any label)
+        :return: The lowest non-zero activation level (None if there are no activated tokens)
+        """
+        minima = []
+        for i, summary in enumerate(self.meta['chunks']):
+            if any(summary['label_act_totals'].values()):
+                values, acts, codes = self.chunk_rows(i)
+                mask = self.row_mask(i, codes, label)
+                if mask is not None:
+                    acts = acts[mask]
+                if (acts != 0).any():
+                    minima.append(acts[acts != 0].min())
+        return float(min(minima)) if minima else None
+
+    def act_sums(self, label):
+        """
+        Computed from the chunk summaries
+        :param label: Label of the tokens
+        :return: Pair (total activation, activation-weighted sum of values) of the tokens of the label
+        """
+        total = sum(summary['label_act_totals'].get(label, 0.0) for summary in self.meta['chunks'])
+        sums = sum((np.asarray(summary['label_act_sums'][label]) for summary in self.meta['chunks']
+                    if label in summary['label_act_sums']), np.zeros(len(self.dims)))
+        return total, sums
+
+    def kernel_sum(self, point, dim_indices, bandwidth, label=None):
+        """
+        Sum of the Gaussian kernels of the tokens at a point (see density()).
+        Chunks farther than KERNEL_CUTOFF bandwidths are not read, unless
+        no token is closer (so that the densities in gaps between tokens aren't 0).
+        :param point: Array of values along the dimensions in dim_indices
+        :param dim_indices: Indices of the dimensions of the kernels
+        :param bandwidth: Bandwidth of the kernels
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Sum of the (unnormalized) kernels (float)
+        """
+        point = np.asarray(point, dtype=np.float64)
+        kernel_sum = 0.0
+        for bound, i in self.candidate_chunks(point, dim_indices, label):
+            if bound > KERNEL_CUTOFF * bandwidth and kernel_sum > 0:
+                break
+            values, acts, codes = self.chunk_rows(i)
+            values = values[:, dim_indices]
+            mask = self.row_mask(i, codes, label)
+            if mask is not None:
+                values = values[mask]
+            kernel_sum += chunked_kernels.kernel_sum(values, point, bandwidth)
+        return float(kernel_sum)
+
+    def density(self, point, dim_indices, bandwidth, label=None):
+        """
+        Gaussian kernel density estimate at a point (same normalization as
+        sklearn.neighbors.KernelDensity), see kernel_sum().
+        :param point: Array of values along the dimensions in dim_indices
+        :param dim_indices: Indices of the dimensions of the density
+        :param bandwidth: Bandwidth of the kernel
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Probability density (float)
+        """
+        n = self.count(label)
+        if n == 0:
+            return 0.0
+        return self.kernel_sum(point, dim_indices, bandwidth, label) / \
+            (n * kernel_norm(bandwidth, len(dim_indices)))
+
+    def tokens_at(self, chunk_ids, rows):
+        """
+        :param chunk_ids: Chunk index of each token
+        :param rows: Row of each token within its chunk
+        :return: List of tokens (class: Token), copies of the stored ones
+        """
+        tokens = []
+        for i, row in zip(chunk_ids, rows):
+            values, acts, codes = self.chunk_rows(i)
+            tokens.append(Token(t_dims=zip(self.dims, values[row].tolist()),
+                                t_act=float(acts[row]), t_label=self.meta['labels'][codes[row]]))
+        return tokens
+
+    def labels_at(self, chunk_ids, rows):
+        """
+        :param chunk_ids: Chunk index of each token
+        :param rows: Row of each token within its chunk
+        :return: Array of the labels of the tokens
+        """
+        codes = np.asarray([self.chunk_rows(i)[2][row] for i, row in zip(chunk_ids, rows)], dtype=np.int64)
+        return self.label_array()[codes]
+
+
+class DiskRepresentation(Representation):
+    def __init__(self, path=None, n=None, dims=None, act=None, label=None, rng=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Representation whose tokens are kept in ChunkedTokenStores on disk.
+        Activation functions, production and Bayesian probabilities work as in Representation,
+        without loading all tokens into memory.
+        Call .close() when the representation is no longer needed, to remove its temporary stores.
+        :param path: Directory of the store (defaults to a new temporary directory)
+        :param chunk_size: Number of tokens per chunk
+        (for the other parameters, see Representation)
+        """
+        Representation.__init__(self, n=n, dims=dims, act=act, label=label, rng=rng)
+        self.chunk_size = chunk_size
+        # The tokens of the representation: pairs (store, label), only the tokens of the label
+        # if it's not None (see combine() and filter_by_label())
+        self.parts = []
+        # The store that new tokens are added to (None if the representation has to create one)
+        self.store = ChunkedTokenStore(path, list(self.dimensions), chunk_size)
+        self.add_part(self.store)
+        # The label and starting activation are kept in the store, for reopening it
+        if label is None:
+            self.label = self.store.meta.get('label', self.label)
+        if act is None:
+            self.starting_act = self.store.meta.get('starting_act', self.starting_act)
+        self.store.meta['label'] = self.label
+        self.store.meta['starting_act'] = self.starting_act
+        self.store.changed()
+        if len(self.store) > 0:
+            self.dimensions = dict.fromkeys(self.store.dims)
+            self.chunk_size = self.store.chunk_size
+            self.update_meta()
+
+    def __str__(self):
+        return "Representation of category " + str(self.label) + " with " + str(self.count()) + \
+               " tokens (on disk: " + ", ".join(store.path for store, label in self.parts) + \
+               ")\nDimensions: " + str(self.dimensions) + '\n'
+
+    def add_part(self, store, label=None):
+        """
+        Makes the tokens of a store part of the representation
+        :param store: ChunkedTokenStore
+        :param label: Only the tokens of this label (defaults to all tokens of the store)
+        :return: None
+        """
+        store.users += 1
+        self.parts.append((store, label))
+
+    def own_store(self):
+        """
+        :return: The store that new tokens are added to, a new temporary one if the current one is shared
+        """
+        if self.store is None:
+            self.store = ChunkedTokenStore(None, list(self.dimensions.keys()), self.chunk_size)
+            self.add_part(self.store)
+        return self.store
+
+    def close(self):
+        """
+        Stops reading the stores of the representation. Temporary stores are removed once no
+        representation reads them (including the ones combined or filtered from this one),
+        the others are written to disk.
+        :return: None
+        """
+        for store, label in self.parts:
+            release(store)
+        self.parts = []
+        self.store = None
+
+    def query_parts(self, label=None):
+        """
+        :param label: Only tokens of this label (defaults to any label)
+        :return: List of pairs (store, label) of the parts that can have tokens of the label
+        """
+        return [(store, label if part_label is None else part_label) for store, part_label in self.parts
+                if label is None or part_label is None or part_label == label]
+
+    def count(self, label=None):
+        """
+        :param label: Only tokens of this label (defaults to any label)
+        :return: Number of tokens
+        """
+        return sum(store.count(part_label) for store, part_label in self.query_parts(label))
+
+    def moments(self):
+        """
+        :return: Triplet (number of tokens, sum of values, sum of outer products of values),
+                 computed from the chunk summaries
+        """
+        n_dims = len(self.dimensions)
+        n, sums, outer = 0, np.zeros(n_dims), np.zeros((n_dims, n_dims))
+        for store, label in self.parts:
+            part_n, part_sums, part_outer = store.moments(label)
+            n, sums, outer = n + part_n, sums + part_sums, outer + part_outer
+        return n, sums, outer
+
+    def update_meta(self):
+        """
+        Updates the attributes based on the chunk summaries
+        :return: None, changes representation in place
+        """
+        n, sums, outer = self.moments()
+        if n < 2:
+            raise stats.StatisticsError('variance requires at least two data points')
+        means = sums / n
+        variances = np.maximum((np.diag(outer) - n * means ** 2) / (n - 1), 0)
+        self.dimensions = {dim: (float(means[d]), float(math.sqrt(variances[d])))
+                           for d, dim in enumerate(self.dimensions)}
+        self.n = n
+
+    def metric(self):
+        """
+        Distance between tokens (see Representation.set_metric()), fitted to the chunk summaries
+        :return: Metric
+        """
+        metric = Metric(list(self.dimensions.keys()), self.weights, self.scaling)
+        metric.set_moments(*self.moments())
+        return metric
+
+    def populate(self):
+        """
+        Populates the store with the required number of tokens of desired distribution,
+        PARTITION_CHUNKS chunks at a time, each in spatial order.
+        :return: None, changes representation in place
+        """
+        means = np.asarray([v[0] for v in self.dimensions.values()])
+        sds = np.asarray([v[1] for v in self.dimensions.values()])
+        store = self.own_store()
+        batch = PARTITION_CHUNKS * store.chunk_size
+        for start in range(0, self.n, batch):
+            m = min(batch, self.n - start)
+            store.append(self.rng.normal(means, sds, size=(m, len(means))),
+                         np.full(m, self.starting_act), [self.label] * m, partition=True)
+        store.flush()
+        self.update_meta()
+
+    def forget(self, f):
+        """
+        "Forgets" f randomly chosen tokens. Their rows are marked as removed in the stores
+        (see ChunkedTokenStore.forget_rows()), the space they take up on disk isn't freed.
+        Tokens in stores that other representations read (see combine()) are first copied
+        to a new store of this representation, so that only this representation forgets them.
+        :param f: Number of elements to delete from representation
+        :return: None, changes representation in place
+        """
+        shared = [(store, label) for store, label in self.parts if store.users > 1]
+        if shared:
+            store = ChunkedTokenStore(None, list(self.dimensions), self.chunk_size)
+            copy_parts(shared, store)
+            for part in shared:
+                self.parts.remove(part)
+                release(part[0])
+            self.add_part(store)
+            if self.store is None:
+                self.store = store
+
+        chosen = np.sort(self.rng.choice(self.count(), f, replace=False))
+        offset = 0
+        for store, label in self.parts:
+            chunk_ids, rows = [], []
+            for i in range(len(store.meta['chunks'])):
+                n_chunk = store.chunk_count(i, label)
+                positions = chosen[(chosen >= offset) & (chosen < offset + n_chunk)] - offset
+                offset += n_chunk
+                if len(positions) > 0:
+                    codes = store.chunk_rows(i)[2]
+                    mask = store.row_mask(i, codes, label)
+                    token_rows = np.arange(len(codes)) if mask is None else np.flatnonzero(mask)
+                    chunk_ids.append(np.full(len(positions), i))
+                    rows.append(token_rows[positions])
+            if chunk_ids:
+                store.forget_rows(np.concatenate(chunk_ids), np.concatenate(rows))
+        self.update_meta()
+
+    def incorporate(self, new_token):
+        """
+        Incorporate a new token into the representation, metadata of representation gets updated
+        :param new_token: Token to be added
+        :return: None, changes representation in place
+        """
+        self.own_store().append([[new_token.dimensions[dim] for dim in self.dimensions]],
+                                [new_token.act], [new_token.label])
+        self.update_meta()
+
+    def produce_new(self, label, starting_act=None):
+        """
+        Produces new token based on the Representation and its current activation pattern
+        :param label: Label of token
+        :param starting_act: Starting activation of token
+        :return: New instantiation of Token
+        """
+        if starting_act is None:
+            starting_act = self.starting_act
+        if label is None:
+            label = self.label
+
+        total, sums = 0.0, np.zeros(len(self.dimensions))
+        for store, part_label in self.query_parts(label):
+            part_total, part_sums = store.act_sums(label)
+            total, sums = total + part_total, sums + part_sums
+        if total == 0:
+            print('You have no activated tokens')
+            return None
+
+        means = sums / total
+        token = Token(t_act=starting_act, t_label=label)
+        token.dimensions = {dim: float(means[d] + self.rng.random() * self.rng.choice([-2, -1, 1, 2]))
+                            for d, dim in enumerate(self.dimensions)}
+        return token
+
+    def view(self, label, parts, path=None):
+        """
+        New representation of the tokens of parts (see combine() and filter_by_label())
+        :param label: Label of the new representation
+        :param parts: List of pairs (store, label), see self.parts
+        :param path: If given, the tokens are copied to a new store in this directory
+        :return: DiskRepresentation (its random number generator is spawned from self's)
+        """
+        new_rep = DiskRepresentation(path, dims=[(dim, v[0], v[1]) for dim, v in self.dimensions.items()],
+                                     label=label, rng=spawn_rngs(self.rng, 1)[0],
+                                     chunk_size=self.chunk_size)
+        if path is None:
+            # The new representation's tokens are added to its own (new) store
+            new_rep.close()
+            for store, part_label in parts:
+                new_rep.add_part(store, part_label)
+        else:
+            copy_parts(parts, new_rep.store)
+            new_rep.store.flush()
+        new_rep.set_metric(self.weights, self.scaling)
+        new_rep.set_kde(self.bandwidth, self.kde_atol, self.kde_rtol)
+        new_rep.update_meta()
+
+        return new_rep
+
+    def combine(self, other_rep, path=None):
+        """
+        Combines two representations into one. By default, the new representation reads the stores of
+        self and other_rep (activation changes are shared, new tokens are not), which have to stay open.
+        :param other_rep: The representation to combine with self (class: DiskRepresentation)
+        :param path: If given, the tokens are copied to a new store in this directory
+        :return: New representation with a potentially multimodal distribution
+                 (its random number generator is spawned from self's)
+        """
+        if self.label == other_rep.label:
+            label = self.label
+        else:
+            label = self.label + "AND" + other_rep.label
+        # From now on, new tokens of self and other_rep go to new (temporary) stores,
+        # so that the new representation doesn't read them
+        self.store, other_rep.store = None, None
+        return self.view(label, self.parts + other_rep.parts, path)
+
+    def filter_by_label(self, label, path=None):
+        """
+        Returns a representation, with all the tokens from the bigger representation with a given label.
+        By default, it reads the stores of self (see combine()).
+        :param label: Label to filter by
+        :param path: If given, the tokens are copied to a new store in this directory
+        :return: DiskRepresentation (its random number generator is spawned from self's)
+        """
+        self.store = None
+        return self.view(label, self.query_parts(label), path)
+
+    def closest_neighbors(self, input_token, k):
+        """
+        Provides the closest k neighbors of input token
+        :param input_token: Input token (class: Token)
+        :param k: How many closest neighbors to return
+        :return: List of k closest neighbors (copies of the stored tokens)
+        """
+        metric = self.metric()
+        part_ids, chunk_ids, rows, dists = nearest(self.parts, metric.vector(input_token), k, metric)
+        return [self.parts[p][0].tokens_at([i], [row])[0] for p, i, row in zip(part_ids, chunk_ids, rows)]
+
+    def fit_kernel(self, dimname, value, label=None):
+        """
+        Gaussian kernel density of a value, jointly over one or more dimensions
+        (exact, up to KERNEL_CUTOFF, reading only the chunks near the value)
+        :param dimname: Name of a dimension, list of names, or None for all dimensions
+        :param value: Value (or list of values, aligned with dimname) to estimate the density at
+        :param label: Only tokens of this label (defaults to all tokens)
+        :return: Probability density (float)
+        """
+        dims = self.dim_list(dimname)
+        n = self.count(label)
+        if n == 0:
+            return 0.0
+        point = np.asarray(value, dtype=np.float64).reshape(len(dims))
+        dim_indices = [list(self.dimensions).index(dim) for dim in dims]
+        kernel_sum = sum(store.kernel_sum(point, dim_indices, self.bandwidth, part_label)
+                         for store, part_label in self.query_parts(label))
+        return kernel_sum / (n * kernel_norm(self.bandwidth, len(dims)))
+
+    def bayesian_prob(self, new_token, dim=None):
+        """
+        Probability of new_token's label given its values (Bayes' theorem,
+        with kernel density estimates), without copying the tokens of the label
+        :param new_token: Token (class: Token)
+        :param dim: Name of a dimension, list of names, or None for all dimensions
+        :return: Probability (float)
+        """
+        label = new_token.label
+        dims = self.dim_list(dim)
+        value = [new_token.dimensions[d] for d in dims]
+
+        p_lab = self.count(label) / self.count()
+        p_value = self.fit_kernel(dims, value)
+        p_of_value_within_lab = self.fit_kernel(dims, value, label)
+
+        # As in Representation.bayesian_prob()
+        bayesian = min((p_lab * p_of_value_within_lab) / p_value, 1.0)
+
+        return bayesian
+
+    # Activation functions
+    def activate_nearest(self, new_token, n, increment, same_label=False):
+        """
+        Increments the activation levels of the n closest exemplars
+        :param new_token: New token that causes activation
+        :param n: Number of tokens to activate
+        :param increment: Function of the array of distances, returning the increments
+        :param same_label: Only increment tokens with the label of new_token
+        :return: None, changes representation in place
+        """
+        metric = self.metric()
+        part_ids, chunk_ids, rows, dists = nearest(self.parts, metric.vector(new_token), n, metric)
+        delta = increment(dists)
+        for p in np.unique(part_ids):
+            store, mask = self.parts[p][0], part_ids == p
+            part_delta = delta[mask]
+            if same_label:
+                part_delta = np.where(store.labels_at(chunk_ids[mask], rows[mask]) == new_token.label,
+                                      part_delta, 0.0)
+            store.add_act(chunk_ids[mask], rows[mask], part_delta)
+
+    def activate_1(self, new_token, n, added_act):
+        """
+        See Representation.activate_1(), only reads the chunks near new_token
+        """
+        self.activate_nearest(new_token, n, lambda dists: np.full(len(dists), added_act))
+
+    def activate_2(self, new_token):
+        """
+        See Representation.activate_2(), reads every chunk
+        """
+        metric = self.metric()
+        point = metric.vector(new_token)
+        for store, label in self.parts:
+            for i in range(len(store.meta['chunks'])):
+                values, acts, codes = store.chunk_rows(i)
+                rows = np.arange(len(values))
+                mask = store.row_mask(i, codes, label)
+                if mask is not None:
+                    rows = rows[mask]
+                dists = chunked_kernels.distances(metric, values[rows], point)
+                store.add_act(np.full(len(rows), i), rows, vec_proportionate_inverse(dists, 0.001))
+
+    def activate_3(self, new_token, n):
+        """
+        See Representation.activate_3(), only reads the chunks near new_token
+        """
+        self.activate_nearest(new_token, n, lambda dists: vec_proportionate_inverse(dists, 0.1))
+
+    def activate_4(self, new_token, n, coeff):
+        """
+        See Representation.activate_4(), only reads the chunks near new_token
+        """
+        self.activate_nearest(new_token, n, lambda dists: vec_proportionate_inverse(dists, 0.1) * coeff,
+                              same_label=True)
+
+    # Deactivation functions: fixed and flexible
+    def deactivate_fix(self, amount):
+        """
+        See Representation.deactivate_fix(), only reads the chunks with activated tokens
+        """
+        for store, label in self.parts:
+            store.update_acts(lambda acts: chunked_kernels.deactivate(acts, amount), label)
+
+    def deactivate_flex(self):
+        """
+        See Representation.deactivate_flex(), only reads the chunks with activated tokens
+        """
+        minima = [store.min_nonzero_act(label) for store, label in self.parts]
+        minima = [act for act in minima if act is not None]
+        self.deactivate_fix(min(minima) if minima else None)
+
+
+# Debugging
+if __name__ == '__main__':
+    rng1, rng2 = spawn_rngs(np.random.default_rng(0), 2)
+    rep1 = DiskRepresentation(n=50, dims=[('dummy_d', 10, 0.5)], act=0.1, label="foo", rng=rng1,
+                              chunk_size=16)
+    rep1.populate()
+
+    rep2 = DiskRepresentation(n=15, dims=[('dummy_d', 100, 0.5)], act=0.1, label="bar", rng=rng2,
+                              chunk_size=16)
+    rep2.populate()
+
+    rep_sum = rep1.combine(rep2)
+
+    input_token = Token(t_dims=[('dummy_d', 55)], t_label="foo")
+    m = rep_sum.bayesian_prob(input_token, 'dummy_d')
+    rep1.activate_4(input_token, 10, m)
+    token1 = rep1.produce_new("foo")
+    rep1.incorporate(token1)
+    #print(rep_sum, m, token1)
+    rep_sum.close()
+    rep1.close()
+    rep2.close()
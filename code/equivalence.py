@@ -0,0 +1,234 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Checking that a candidate engine       ##
+## produces the same distributions        ##
+## as the reference model                 ##
+############################################
+
+# An engine is a function engine(config, seed), which runs one shadowing task
+# and returns the produced tokens' dimensions (list of dictionaries).
+# A config is a dictionary with the speaker's profile ('profile'), the stimulus
+# category ('cat'), the interlocutor's token ('token'), optionally a 'name',
+# and any further keyword arguments to shadow().
+# Optimized engines won't reproduce the reference outputs exactly (floating point
+# details, order of random numbers), so trajectories are compared as distributions over seeds.
+# The reference engine runs the frozen copy of the model in reference_model.py, so it
+# doesn't change when the model is optimized.
+
+import copy
+import time
+import numpy as np
+from scipy import stats as sp_stats
+
+from representation_token_class import Token
+from acc_simulation import SPEAKER_PROFILES, build_speaker, shadow
+from shared_baseline import SharedBaseline
+import reference_model
+
+
+CONFIG_KEYS = ('name', 'profile', 'cat', 'token')
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def shadow_options(config):
+    """
+    :param config: Simulation configuration (see above)
+    :return: Keyword arguments of shadow() in the configuration
+    """
+    return {k: v for k, v in config.items() if k not in CONFIG_KEYS}
+
+
+def run_config(speaker, config, shadow_func=shadow):
+    """
+    Runs the shadowing task of a configuration on a speaker
+    :param speaker: Dictionary of representations (see acc_simulation.build_speaker())
+    :param config: Simulation configuration (see above)
+    :param shadow_func: Implementation of the shadowing task
+    :return: List of the dimensions of the produced tokens
+    """
+    # The interlocutor's token is incorporated (and activated), so every run gets its own copy
+    i_token = copy.deepcopy(config['token'])
+    trajectory = shadow_func(speaker[config['cat']], speaker['all'], i_token, **shadow_options(config))
+    return [t.dimensions for t in trajectory]
+
+
+def reference_engine(config, seed):
+    """
+    The reference model (reference_model.py): sets up the speaker and runs the shadowing task
+    :param config: Simulation configuration (see above)
+    :param seed: Random seed
+    :return: List of the dimensions of the produced tokens
+    """
+    profile = config['profile']
+    if isinstance(profile, str):
+        profile = SPEAKER_PROFILES[profile]
+    speaker = reference_model.build_speaker(profile, np.random.default_rng(seed))
+    return run_config(speaker, config, reference_model.shadow)
+
+
+def current_engine(config, seed):
+    """
+    The current model: sets up the speaker with acc_simulation.build_speaker() and runs shadow()
+    :param config: Simulation configuration (see above)
+    :param seed: Random seed
+    :return: List of the dimensions of the produced tokens
+    """
+    return run_config(build_speaker(config['profile'], rng=np.random.default_rng(seed)), config)
+
+
+def run_engine(engine, configs, seeds):
+    """
+    Runs an engine on every configuration with every seed
+    :param engine: Engine to run (see above)
+    :param configs: List of configurations
+    :param seeds: List of random seeds
+    :return: Pair of (list of trajectories per configuration, total running time in seconds)
+    """
+    trajectories = []
+    start = time.perf_counter()
+    for config in configs:
+        trajectories.append([engine(config, seed) for seed in seeds])
+    return trajectories, time.perf_counter() - start
+
+
+def compare_samples(reference, candidate, mean_tol, quantile_tol, alpha):
+    """
+    Compares two samples of produced values
+    :param reference: Values from the reference engine
+    :param candidate: Values from the candidate engine
+    :param mean_tol: Largest accepted difference of the means
+    :param quantile_tol: Largest accepted difference of the quantiles (see QUANTILES)
+    :param alpha: Significance level of the two-sample Kolmogorov-Smirnov test
+    :return: Dictionary of the statistics, with 'passed' (boolean)
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+
+    mean_diff = abs(candidate.mean() - reference.mean())
+    quantile_diff = float(np.max(np.abs(np.quantile(candidate, QUANTILES) -
+                                        np.quantile(reference, QUANTILES))))
+    ks = sp_stats.ks_2samp(reference, candidate)
+
+    return {'mean_ref': float(reference.mean()),
+            'mean_cand': float(candidate.mean()),
+            'mean_diff': float(mean_diff),
+            'quantile_diff': quantile_diff,
+            'ks_stat': float(ks.statistic),
+            'ks_p': float(ks.pvalue),
+            'passed': bool(mean_diff <= mean_tol and quantile_diff <= quantile_tol
+                           and ks.pvalue >= alpha)}
+
+
+def compare(reference, candidate, configs, seeds, checkpoints=None,
+            mean_tol=1.0, quantile_tol=2.0, length_tol=1.0, alpha=0.01):
+    """
+    Runs the reference and the candidate engine over the same configurations and seeds,
+    and compares the distributions of their productions at the checkpoints, and of the
+    lengths of their trajectories (the iteration they converged at).
+    A configuration fails if no checkpoint was reached by all runs.
+    :param reference: Reference engine (usually reference_engine)
+    :param candidate: Candidate engine
+    :param configs: List of configurations
+    :param seeds: List of random seeds
+    :param checkpoints: Iterations (indices in the trajectories) to compare,
+                        defaults to every iteration
+    :param mean_tol: Largest accepted difference of the means, in the units of the dimensions
+    :param quantile_tol: Largest accepted difference of the quantiles
+    :param length_tol: Largest accepted difference of the mean trajectory lengths, in iterations
+    :param alpha: Overall significance level of the Kolmogorov-Smirnov tests
+                  (Bonferroni-corrected for the number of comparisons)
+    :return: Report (dictionary) with 'passed', 'speedup', the per-comparison 'results'
+             and the configurations without any checkpoint to compare ('uncompared')
+    """
+    ref_trajectories, ref_time = run_engine(reference, configs, seeds)
+    cand_trajectories, cand_time = run_engine(candidate, configs, seeds)
+
+    comparisons = []
+    uncompared = []
+    for config, ref_runs, cand_runs in zip(configs, ref_trajectories, cand_trajectories):
+        name = config.get('name', str(config['token']))
+        # The lengths are small integers: their quantiles are not compared
+        comparisons.append((name, None, 'length', [len(run) for run in ref_runs],
+                            [len(run) for run in cand_runs], length_tol, float('inf')))
+
+        # Trajectories can end early (convergence), only iterations all runs reached are compared
+        length = min(len(run) for run in ref_runs + cand_runs)
+        config_checkpoints = range(length) if checkpoints is None else \
+            [i for i in checkpoints if i < length]
+        if len(config_checkpoints) == 0:
+            uncompared.append(name)
+        for i in config_checkpoints:
+            for dim in sorted(ref_runs[0][i].keys()):
+                comparisons.append((name, i, dim,
+                                    [run[i][dim] for run in ref_runs],
+                                    [run[i][dim] for run in cand_runs], mean_tol, quantile_tol))
+
+    corrected_alpha = alpha / max(len(comparisons), 1)
+    results = []
+    for name, i, dim, ref_values, cand_values, value_tol, value_quantile_tol in comparisons:
+        result = compare_samples(ref_values, cand_values, value_tol, value_quantile_tol, corrected_alpha)
+        result.update({'config': name, 'iteration': i, 'dim': dim})
+        results.append(result)
+
+    return {'passed': len(uncompared) == 0 and all(r['passed'] for r in results),
+            'speedup': ref_time / cand_time if cand_time > 0 else float('inf'),
+            'reference_time': ref_time,
+            'candidate_time': cand_time,
+            'results': results,
+            'uncompared': uncompared}
+
+
+def print_report(report):
+    """
+    Prints a summary of a report returned by compare()
+    :param report: Report to print
+    :return: None
+    """
+    for r in report['results']:
+        print('{}\t{}\ti={}\tmean {:.3f} vs {:.3f}\tquantiles +-{:.3f}\tKS p={:.3g}\t{}'.format(
+            r['config'], r['dim'], r['iteration'], r['mean_ref'], r['mean_cand'],
+            r['quantile_diff'], r['ks_p'], 'ok' if r['passed'] else 'FAIL'))
+    for name in report['uncompared']:
+        print('{}\tno checkpoint reached by all runs\tFAIL'.format(name))
+    print('Reference: {:.2f}s, candidate: {:.2f}s, speedup: {:.2f}x'.format(
+        report['reference_time'], report['candidate_time'], report['speedup']))
+    print('PASS' if report['passed'] else 'FAIL')
+
+
+# Debugging: shared baseline forks as candidate engine
+if __name__ == '__main__':
+    def forked_engine(config, seed):
+        # Like the reference, every seed has its own baseline speaker
+        rng = np.random.default_rng(seed)
+        baseline = SharedBaseline.create(build_speaker(config['profile'], rng=rng))
+        try:
+            return run_config(baseline.fork(rng), config)
+        finally:
+            baseline.close()
+            baseline.unlink()
+
+    configs = [{'name': 'p_15', 'profile': 'F08', 'cat': 'p',
+                'token': Token(t_dims=[('VOT', 15)], t_label='p'), 'max_iter': 20},
+               {'name': 'p_130', 'profile': 'F08', 'cat': 'p',
+                'token': Token(t_dims=[('VOT', 130)], t_label='p'), 'max_iter': 20,
+                'tol': 1.0}]
+    report = compare(reference_engine, forked_engine, configs, seeds=range(20),
+                     checkpoints=[0, 4, 9, 19])
+    print_report(report)
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Frozen reference implementation of     ##
+## the model (see equivalence.py)         ##
+############################################
+
+# A copy of the model as it was before it was optimized: tokens sorted by scipy distances,
+# summaries with the statistics module, kernel density estimates fitted on every call.
+# Only the random numbers come from a numpy Generator, so that runs can be seeded.
+# Faster implementations are checked against this file, so don't optimize or refactor it.
+
+import statistics as stats
+import math
+import numpy as np
+from scipy.spatial import distance
+from sklearn.neighbors import KernelDensity
+
+# The stopping rule of the shadowing task isn't part of the model: both engines use the current one
+from acc_simulation import converged
+
+
+def sigmoid(x):
+    return 1 / (1 + math.exp(-x))
+
+def proportionate_inverse(x):
+    return sigmoid(1/x)
+
+
+class Token:
+    def __init__(self, t_dims=None, t_act=None, t_label=None):
+        """
+        :param t_dims: Tuple of dimensions, where each dimension is a pair of the form:
+                     ('name', value)
+        :param t_act: Activation of new token
+        :param t_label: Label of the token
+        """
+        if t_dims is None:
+            t_dims=()
+        self.dimensions = {dim[0]: dim[1] for dim in t_dims}
+
+        if t_act is None:
+            self.act=0.0
+        else:
+            self.act = t_act
+
+        if t_label is None:
+            self.label = ""
+        else:
+            self.label = t_label
+
+
+class Representation:
+    def __init__(self, n=None, dims=None, act=None, label=None, rng=None):
+        """
+        :param n: Number of tokens to initialize the Representation object with
+        :param dims: Tuple of dimensions, where each dimension is a triplet of the form:
+                     ('name', mean, standard deviation)
+        :param act: Starting activation of tokens
+        :param label: Label of the representation
+        :param rng: Random number generator (class: numpy.random.Generator)
+        """
+        if n is None:
+            self.n=0
+        else:
+            self.n = n
+
+        if dims is None:
+            self.dimensions = ()
+        else:
+            self.dimensions = {dim[0]: (dim[1], dim[2]) for dim in dims}
+
+        if act is None:
+            self.starting_act = 0.0
+        else:
+            self.starting_act = act
+
+        if label is None:
+            self.label = ""
+        else:
+            self.label = label
+
+        self.rng = rng
+        self.tokens=[]
+
+    def update_meta(self):
+        for dim in self.dimensions.keys():
+            self.dimensions[dim] = (stats.mean([token.dimensions[dim] for token in self.tokens]),
+                                    stats.stdev([token.dimensions[dim] for token in self.tokens]))
+        self.n = len(self.tokens)
+
+    def populate(self):
+        for i in range(self.n):
+            t = Token(t_act=self.starting_act, t_label=self.label)
+            t.dimensions = {dim: float(self.rng.normal(v[0], v[1])) for dim, v in self.dimensions.items()}
+            self.tokens.append(t)
+        self.update_meta()
+
+    def incorporate(self, new_token):
+        self.tokens.append(new_token)
+        self.update_meta()
+
+    def produce_new(self, label, starting_act=None):
+        if starting_act is None:
+            starting_act = self.starting_act
+        activated = [act_t for act_t in self.tokens if act_t.act != 0 and act_t.label == label]
+        token = Token()
+        token.dimensions={}
+        if label == None:
+            token.label = self.label
+        else:
+            token.label = label
+
+        try:
+            for dim in self.dimensions.keys():
+                token.dimensions[dim] = sum([token.dimensions[dim] * token.act for token in activated]) /\
+                             sum([token.act for token in activated]) + (self.rng.random() *
+                                                                        int(self.rng.choice([-2, -1, 1, 2])))
+                token.act = starting_act
+            return token
+        except ZeroDivisionError:
+            print('You have no activated tokens')
+
+    def combine(self, other_rep):
+        new_rep = Representation(n=self.n+other_rep.n, act=None, rng=self.rng)
+        new_rep.dimensions={dim_k: (self.dimensions[dim_k][0],
+                                    self.dimensions[dim_k][1])
+                            for dim_k in self.dimensions.keys()}
+        new_rep.tokens = self.tokens + other_rep.tokens
+
+        if self.label == other_rep.label:
+            new_rep.label = self.label
+        else:
+            new_rep.label = self.label + "AND" + other_rep.label
+
+        new_rep.update_meta()
+
+        return new_rep
+
+    def filter_by_label(self, label):
+        new_rep = Representation(label=label, rng=self.rng)
+        new_rep.dimensions = {dim_k: (self.dimensions[dim_k][0],
+                                      self.dimensions[dim_k][1])
+                              for dim_k in self.dimensions.keys()}
+        new_rep.tokens = [t for t in self.tokens if t.label==label]
+        new_rep.update_meta()
+
+        return new_rep
+
+    def fit_kernel(self, dimname, value):
+        bw= 2.5
+        obs_values= np.asarray([t.dimensions[dimname] for t in self.tokens])
+        model = KernelDensity(bandwidth=bw, kernel='gaussian')
+        obs_values = obs_values.reshape((len(obs_values), 1))
+        model.fit(obs_values)
+
+        value_format = np.asarray([value])
+        value_format = value_format.reshape((len(value_format), 1))
+        probability = model.score_samples(value_format)[0]
+        probability = np.exp(probability)
+
+        return probability
+
+    def bayesian_prob(self, new_token, dim):
+        label = new_token.label
+        value = new_token.dimensions[dim]
+
+        others_with_lab = self.filter_by_label(label)
+        p_lab = len(others_with_lab.tokens) / len(self.tokens)
+        p_value = self.fit_kernel(dim, value)
+        p_of_value_within_lab = others_with_lab.fit_kernel(dim, value)
+
+        bayesian = (p_lab * p_of_value_within_lab) / p_value
+
+        return bayesian
+
+    def activate_4(self, new_token, n, coeff):
+        # Sort exemplars by their distance from the new token
+        self.tokens.sort(key=lambda t: distance.euclidean(
+            [v for k, v in t.dimensions.items()],
+            [v for k, v in new_token.dimensions.items()]))
+        # Modify the closest n exemplar's activation level
+        for i in range(n):
+            dist = distance.euclidean(
+                [v for k, v in self.tokens[i].dimensions.items()],
+                [v for k, v in new_token.dimensions.items()])
+            if dist == 0:
+                dist = 0.1
+            if new_token.label == self.tokens[i].label:
+                self.tokens[i].act += proportionate_inverse(dist) * coeff
+
+
+def shadow(speaker_cat, speaker_reps, i_token, n_act=100, max_iter=20,
+           window=5, tol=None, target=None, dims=None):
+    """
+    The shadowing task (see acc_simulation.shadow()), over a single dimension
+    :return: List of tokens produced by the speaker
+    """
+    if dims is None:
+        dims = list(speaker_reps.dimensions.keys())
+    if not isinstance(dims, str):
+        if len(dims) != 1:
+            raise ValueError('The reference model works along a single dimension')
+        dims = dims[0]
+
+    trajectory = []
+    for i in range(max_iter):
+        m_i = speaker_reps.bayesian_prob(i_token, dims)
+        speaker_cat.activate_4(i_token, n_act, m_i)
+        speaker_cat.incorporate(i_token)
+        speaker_reps.incorporate(i_token)
+
+        sp_token = speaker_cat.produce_new(i_token.label, starting_act=0.1)
+        m_sp = speaker_reps.bayesian_prob(sp_token, dims)
+        speaker_cat.activate_4(sp_token, n_act, m_sp)
+        speaker_cat.incorporate(sp_token)
+        speaker_reps.incorporate(sp_token)
+        trajectory.append(sp_token)
+
+        if tol is not None and converged(trajectory, window, tol, target):
+            break
+
+    return trajectory
+
+
+def build_speaker(profile, rng, act=0.1):
+    """
+    Sets up a speaker (see acc_simulation.build_speaker())
+    :param profile: Profile of the form of acc_simulation.SPEAKER_PROFILES' values
+    :param rng: Random number generator (class: numpy.random.Generator)
+    :param act: Starting activation of tokens
+    :return: Dictionary of representations: one per category label,
+             and all categories combined under 'all'
+    """
+    speaker = {}
+    for label, components in profile.items():
+        for n, dims in components:
+            component = Representation(n=n, dims=dims, act=act, label=label, rng=rng)
+            component.populate()
+            if label in speaker:
+                speaker[label] = speaker[label].combine(component)
+            else:
+                speaker[label] = component
+
+    categories = list(speaker.values())
+    speaker['all'] = categories[0]
+    for category in categories[1:]:
+        speaker['all'] = speaker['all'].combine(category)
+
+    return speaker
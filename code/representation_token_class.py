@@ -21,12 +21,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 ## and its utility functions             ##
 ###########################################
 
-import random
 import statistics as stats
-from scipy.spatial import distance
 import math
+import weakref
 import numpy as np
-from sklearn.neighbors import KernelDensity
+from sklearn.neighbors import KDTree
+
+import chunked_kernels
 
 
 def sigmoid(x):
@@ -35,6 +36,40 @@ def sigmoid(x):
 def proportionate_inverse(x):
     return sigmoid(1/x)
 
+def vec_proportionate_inverse(dists, zero_dist):
+    """
+    proportionate_inverse() of an array of distances
+    :param dists: Array of distances
+    :param zero_dist: Distance used instead of 0
+    :return: Array of sigmoid(1/distance)
+    """
+    dists = np.where(dists == 0, zero_dist, dists)
+    return 1 / (1 + np.exp(-1 / dists))
+
+# Ways of scaling dimensions before measuring distances (see Metric)
+SCALINGS = (None, 'zscore', 'mahalanobis')
+
+# Kernel density trees are rebuilt when this fraction of the tokens was incorporated since
+KDE_REFIT_FRACTION = 0.05
+
+# Leaf size of the kernel density trees (queries are traversed breadth first).
+# At 150,000 tokens along 2 dimensions, a query takes about 1.5ms when the tokens are spread
+# over many bandwidths (SD 20, bandwidth 2.5), and about 11ms when they are all within
+# a bandwidth of each other (SD 0.5), where the tree can't skip any of them.
+KDE_LEAF_SIZE = 100
+
+
+def spawn_rngs(rng, n):
+    """
+    Independent child random number generators, e.g. one per speaker, replica or worker.
+    The children only depend on the parent's seed and on how many were spawned before.
+    :param rng: Parent generator (class: numpy.random.Generator)
+    :param n: Number of children
+    :return: List of generators
+    """
+    return [np.random.default_rng(seed) for seed in rng.bit_generator.seed_seq.spawn(n)]
+
+
 class Token:
     def __init__(self, t_dims=None, t_act=None, t_label=None):
         """
@@ -47,6 +82,10 @@ class Token:
         :return:
         """
 
+        # Slot of the activation level, once the token is incorporated (see ActivationTable)
+        self.table = None
+        self.slot = None
+
         #dict.__init__(self, {})
         if t_dims is None:
             t_dims=()
@@ -62,6 +101,33 @@ class Token:
         else:
             self.label = t_label
 
+    @property
+    def act(self):
+        """
+        Activation level of the token. Once the token is incorporated into a representation,
+        it is kept in the ActivationTable shared by all the representations holding the token.
+        """
+        if self.table is None:
+            return self._act
+        return self.table.act(self.slot)
+
+    @act.setter
+    def act(self, value):
+        if self.table is None:
+            self._act = value
+        else:
+            self.table.set_act(self.slot, value)
+
+    def __getstate__(self):
+        # Copies of a token (and tokens sent to other processes) are not in any table
+        return {'dimensions': self.dimensions, 'act': self.act, 'label': self.label}
+
+    def __setstate__(self, state):
+        self.table = None
+        self.slot = None
+        self.dimensions = state['dimensions']
+        self._act = state['act']
+        self.label = state['label']
 
     def __str__(self):
         str_output = "Token with " + str(self.dimensions) + \
@@ -71,8 +137,703 @@ class Token:
         return str_output
 
 
+class Metric:
+    def __init__(self, dims, weights=None, scaling=None):
+        """
+        Distance between tokens along named dimensions, with optional weights and scaling
+        :param dims: List of dimension names, in the order of the columns of value arrays
+        :param weights: Dictionary of weights per dimension name (missing dimensions have weight 1)
+        :param scaling: None (raw values), 'zscore' (values divided by their standard deviation)
+                        or 'mahalanobis' (Mahalanobis distance, using the covariance of the tokens)
+        """
+        if scaling not in SCALINGS:
+            raise ValueError('Unknown scaling: ' + str(scaling))
+        if weights is None:
+            weights = {}
+
+        self.dims = list(dims)
+        self.weights = np.sqrt(np.asarray([weights.get(dim, 1.0) for dim in self.dims], dtype=np.float64))
+        self.scaling = scaling
+        self.plain = scaling is None and not weights
+
+        # Running moments of the tokens, for the scaling
+        self.n = 0
+        self.sums = np.zeros(len(self.dims))
+        self.outer = np.zeros((len(self.dims), len(self.dims)))
+        self.matrix = None
+
+    def set_moments(self, n, sums, outer):
+        """
+        :param n: Number of tokens
+        :param sums: Sum of the values of the tokens
+        :param outer: Sum of the outer products of the values of the tokens
+        :return: None
+        """
+        self.n = n
+        self.sums = np.asarray(sums, dtype=np.float64)
+        self.outer = np.asarray(outer, dtype=np.float64)
+        self.matrix = None
+
+    def update(self, values):
+        """
+        Adds tokens to the running moments
+        :param values: Values of the new tokens (array of shape (m, number of dimensions))
+        :return: None
+        """
+        self.set_moments(self.n + len(values), self.sums + values.sum(axis=0),
+                         self.outer + values.T @ values)
+
+    def covariance(self):
+        means = self.sums / self.n
+        return (self.outer - self.n * np.outer(means, means)) / (self.n - 1)
+
+    def transform(self):
+        """
+        Linear transformation of value differences, after which distances are Euclidean
+        :return: Array of shape (number of dimensions, number of dimensions)
+        """
+        if self.matrix is None:
+            if self.scaling == 'mahalanobis':
+                # inverse covariance = C C^T, distance^2 = |diff W C|^2
+                self.matrix = self.weights[:, None] * np.linalg.cholesky(np.linalg.inv(self.covariance()))
+            elif self.scaling == 'zscore':
+                self.matrix = np.diag(self.weights / np.sqrt(np.diag(self.covariance())))
+            else:
+                self.matrix = np.diag(self.weights)
+        return self.matrix
+
+    def lower_bound_factor(self):
+        """
+        :return: Smallest factor by which the transformation shrinks Euclidean distances
+        """
+        if self.plain:
+            return 1.0
+        return float(np.linalg.svd(self.transform(), compute_uv=False).min())
+
+    def vector(self, token):
+        """
+        :param token: Token (class: Token)
+        :return: Array of the token's values, aligned with self.dims
+        """
+        return np.asarray([token.dimensions[dim] for dim in self.dims], dtype=np.float64)
+
+    def distances(self, values, point):
+        """
+        Distances of many tokens from a point, in one vectorized operation
+        :param values: Values of the tokens (array of shape (n, number of dimensions))
+        :param point: Array of values, aligned with self.dims
+        :return: Array of n distances
+        """
+        diffs = values - point
+        if not self.plain:
+            if self.scaling == 'mahalanobis':
+                diffs = diffs @ self.transform()
+            else:
+                diffs = diffs * np.diag(self.transform())
+        return np.sqrt((diffs ** 2).sum(axis=1))
+
+
+def grow(array, size):
+    """
+    :param array: Buffer array (first axis: rows)
+    :param size: Number of rows needed
+    :return: The array, or a copy of it with room for at least size rows (doubling)
+    """
+    if size <= len(array):
+        return array
+    new = np.empty((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    new[:len(array)] = array
+    return new
+
+
+def summaries(values, codes, acts, n_labels):
+    """
+    :param values: Values of tokens (array of shape (number of tokens, number of dimensions))
+    :param codes: Their label codes
+    :param acts: Their activation levels
+    :param n_labels: Number of label codes
+    :return: Summaries of the tokens (dictionary of arrays: 'label_counts', 'act_sums',
+             'act_totals' per label code, and the moments 'sums' and 'outer')
+    """
+    act_sums = np.zeros((n_labels, values.shape[1]))
+    act_totals = np.zeros(n_labels)
+    for code in range(n_labels):
+        act_sums[code], act_totals[code] = chunked_kernels.weighted_sum(
+            values, np.where(codes == code, acts, 0.0))
+    return {'label_counts': np.bincount(codes, minlength=n_labels),
+            'act_sums': act_sums,
+            'act_totals': act_totals,
+            'sums': values.sum(axis=0),
+            'outer': values.T @ values}
+
+
+class ActivationTable:
+    def __init__(self, base=None):
+        """
+        Activation levels of tokens, one slot per token, shared by all the representations
+        holding the token: their TokenArrays are notified of every change (see TokenArrays.changed()).
+        A token gets a slot when it is first incorporated, and from then on its act attribute
+        reads and writes the slot. Tables are merged when a representation holds tokens of two
+        tables (e.g. after Representation.combine()).
+        The first slots can be the tokens of a read-only base (e.g. a baseline in shared memory,
+        see shared_baseline.py). Their changed activation levels are kept in a private overlay,
+        or in a private copy of all of them once more than an eighth changed.
+        Tables with a base are not merged with each other: a token of one of them incorporated
+        into a representation of the other gets a second, independent activation level there.
+        :param base: Dictionary with the starting activation levels of the base tokens ('acts'),
+                     their 'values' and their label 'codes'
+        """
+        if base is None:
+            base = {'acts': np.empty(0)}
+        self.base = base
+        self.base_acts = base['acts']
+        self.n_base = len(self.base_acts)
+        # Changed activation levels of base slots (slot: activation), or all of them (dense_acts)
+        self.overlay = {}
+        self.dense_acts = None
+
+        # Slots after the base: activation levels and Token objects (None if not bound to the slot)
+        self.n = self.n_base
+        self.acts = np.empty(16)
+        self.tokens = []
+
+        # Weak references to the TokenArrays reading the table
+        self.listeners = []
+
+    def __len__(self):
+        return self.n
+
+    def listen(self, arrays):
+        """
+        :param arrays: TokenArrays to notify of changes
+        :return: None
+        """
+        self.listeners.append(weakref.ref(arrays))
+
+    def base_changed(self):
+        """
+        :return: Whether activation levels of base slots changed
+        """
+        return self.dense_acts is not None or bool(self.overlay)
+
+    def base_slot_acts(self):
+        """
+        :return: Activation levels of the base slots (private copy)
+        """
+        if self.dense_acts is not None:
+            return self.dense_acts.copy()
+        acts = self.base_acts.copy()
+        if self.overlay:
+            acts[np.fromiter(self.overlay.keys(), dtype=np.int64, count=len(self.overlay))] = \
+                np.fromiter(self.overlay.values(), dtype=np.float64, count=len(self.overlay))
+        return acts
+
+    def act(self, slot):
+        """
+        :param slot: Slot
+        :return: Activation level of the slot
+        """
+        if slot >= self.n_base:
+            return float(self.acts[slot - self.n_base])
+        if self.dense_acts is not None:
+            return float(self.dense_acts[slot])
+        return self.overlay.get(slot, float(self.base_acts[slot]))
+
+    def get(self, slots):
+        """
+        :param slots: Array of slots
+        :return: Array of their activation levels
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        out = np.empty(len(slots))
+        own = slots >= self.n_base
+        out[own] = self.acts[slots[own] - self.n_base]
+        base_slots = slots[~own]
+        if len(base_slots) == 0:
+            return out
+        if self.dense_acts is not None:
+            out[~own] = self.dense_acts[base_slots]
+        elif len(base_slots) > 256:
+            out[~own] = self.base_slot_acts()[base_slots]
+        else:
+            out[~own] = [self.overlay.get(slot, float(self.base_acts[slot]))
+                         for slot in base_slots.tolist()]
+        return out
+
+    def set(self, slots, acts):
+        """
+        Sets activation levels, and notifies the TokenArrays reading the table
+        :param slots: Array of slots (without repetitions)
+        :param acts: Array of their new activation levels
+        :return: None
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        acts = np.asarray(acts, dtype=np.float64)
+        deltas = acts - self.get(slots)
+
+        own = slots >= self.n_base
+        self.acts[slots[own] - self.n_base] = acts[own]
+        base_slots, base_acts = slots[~own], acts[~own]
+        if len(base_slots) > 0:
+            if self.dense_acts is None and len(self.overlay) + len(base_slots) > self.n_base // 8:
+                # most base slots changed: keep a private copy of all of them
+                self.dense_acts = self.base_slot_acts()
+                self.overlay = {}
+            if self.dense_acts is not None:
+                self.dense_acts[base_slots] = base_acts
+            else:
+                self.overlay.update(zip(base_slots.tolist(), base_acts.tolist()))
+
+        alive = []
+        for ref in self.listeners:
+            arrays = ref()
+            if arrays is not None:
+                arrays.changed(slots, deltas)
+                alive.append(ref)
+        self.listeners = alive
+
+    def set_act(self, slot, act):
+        """
+        :param slot: Slot
+        :param act: New activation level of the slot
+        :return: None
+        """
+        self.set(np.asarray([slot]), np.asarray([act], dtype=np.float64))
+
+    def add(self, slots, deltas):
+        """
+        Increases activation levels
+        :param slots: Array of slots
+        :param deltas: Increments (array aligned with slots, or a number)
+        :return: None
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        deltas = np.broadcast_to(np.asarray(deltas, dtype=np.float64), slots.shape)
+        unique, inverse = np.unique(slots, return_inverse=True)
+        self.set(unique, self.get(unique) + np.bincount(inverse, weights=deltas, minlength=len(unique)))
+
+    def new_slots(self, tokens, bind=True):
+        """
+        Adds slots for tokens, with their current activation levels
+        :param tokens: List of tokens (class: Token)
+        :param bind: Whether the tokens' act attribute reads and writes the new slots from now on
+        :return: Array of the slots
+        """
+        m = len(tokens)
+        first = self.n - self.n_base
+        self.acts = grow(self.acts, first + m)
+        self.acts[first:first + m] = [t.act for t in tokens]
+        slots = np.arange(self.n, self.n + m)
+        if bind:
+            for t, slot in zip(tokens, slots.tolist()):
+                t.table, t.slot = self, slot
+            self.tokens.extend(tokens)
+        else:
+            self.tokens.extend([None] * m)
+        self.n += m
+        return slots
+
+    def merge(self, other):
+        """
+        Merges two tables: the slots of one of them are moved to the end of the other
+        (the one with a base, or else the larger one), with their tokens and TokenArrays
+        :param other: ActivationTable
+        :return: The table holding both, or None if both have a base
+        """
+        if self.n_base > 0 and other.n_base > 0:
+            return None
+        if other.n_base > 0 or (self.n_base == 0 and len(other) > len(self)):
+            return other.merge(self)
+
+        offset = self.n
+        first = self.n - self.n_base
+        self.acts = grow(self.acts, first + other.n)
+        self.acts[first:first + other.n] = other.acts[:other.n]
+        for t in other.tokens:
+            if t is not None:
+                t.table = self
+                t.slot += offset
+        self.tokens.extend(other.tokens)
+        self.n += other.n
+        for ref in other.listeners:
+            arrays = ref()
+            if arrays is not None:
+                arrays.moved(self, offset)
+                self.listeners.append(ref)
+
+        other.n = 0
+        other.tokens = []
+        other.listeners = []
+        return self
+
+
+class TokenArrays:
+    def __init__(self, dims, base=None):
+        """
+        Values and labels of the tokens of a representation, as arrays, with running summaries:
+        the moments of the values, the number of tokens per label (see bayesian_prob()) and
+        the activation-weighted sums of the values per label (see produce_new()).
+        The rows are the read-only rows of an optional base (e.g. a baseline in shared memory,
+        see shared_baseline.py), followed by the rows of the representation's own tokens.
+        Activation levels are kept per token, in the slots of an ActivationTable shared with
+        the other representations holding the tokens: a token incorporated more than once
+        has one activation level, counted once for every time it was incorporated.
+        :param dims: List of dimension names, in the order of the columns
+        :param base: Dictionary with the arrays of the base rows ('values', 'codes' and the
+                     'slots' of their tokens in the base of the ActivationTable 'table'),
+                     the number of rows of every base slot ('slot_counts'), the 'labels' of
+                     the codes, and optionally their 'summaries' (see summaries()) and
+                     a dictionary of k-d trees shared by the representations on top of
+                     the same base ('kernels')
+        """
+        self.dims = list(dims)
+        n_dims = len(self.dims)
+
+        if base is None:
+            base = {'values': np.empty((0, n_dims)), 'codes': np.empty(0, dtype=np.int32),
+                    'slots': np.empty(0, dtype=np.int64), 'slot_counts': np.empty(0, dtype=np.int64),
+                    'labels': [], 'table': ActivationTable()}
+        self.base_values = base['values']
+        self.base_codes = base['codes']
+        self.base_slots = base['slots']
+        self.base_slot_counts = base['slot_counts']
+        self.base_kernels = base.get('kernels', {})
+        self.n_base = len(self.base_values)
+        self.table = base['table']
+        self.table.listen(self)
+
+        # One row per incorporated token (buffers grow by doubling, see grow())
+        self.n = 0
+        self.values = np.empty((16, n_dims))
+        self.codes = np.empty(16, dtype=np.int32)
+        self.slots = np.empty(16, dtype=np.int64)
+
+        # One entry per slot of the own rows: its first Token object, table slot, first row
+        # and number of rows (slot_of: table slot -> entry)
+        self.slot_tokens = []
+        self.slot_of = {}
+        self.slot_ids = np.empty(16, dtype=np.int64)
+        self.slot_rows = np.empty(16, dtype=np.int64)
+        self.slot_counts = np.empty(16, dtype=np.int64)
+
+        self.labels = list(base['labels'])
+        self.label_codes = {label: code for code, label in enumerate(self.labels)}
+        base_summaries = base.get('summaries')
+        if base_summaries is None or self.table.base_changed():
+            base_summaries = self.base_summaries()
+        self.label_counts = np.array(base_summaries['label_counts'], dtype=np.int64)
+        self.act_sums = np.array(base_summaries['act_sums'], dtype=np.float64).reshape((-1, n_dims))
+        self.act_totals = np.array(base_summaries['act_totals'], dtype=np.float64)
+        self.sums = np.array(base_summaries['sums'], dtype=np.float64)
+        self.outer = np.array(base_summaries['outer'], dtype=np.float64).reshape((n_dims, n_dims))
+
+    def __len__(self):
+        return self.n_base + self.n
+
+    def base_summaries(self):
+        """
+        :return: Summaries of the base rows (see summaries())
+        """
+        return summaries(self.base_values, self.base_codes, self.table.get(self.base_slots),
+                         len(self.labels))
+
+    def code(self, label):
+        """
+        :param label: Label
+        :return: Code of the label (new labels get the next code)
+        """
+        if label not in self.label_codes:
+            self.label_codes[label] = len(self.labels)
+            self.labels.append(label)
+            self.label_counts = np.append(self.label_counts, 0)
+            self.act_sums = np.vstack([self.act_sums, np.zeros((1, len(self.dims)))])
+            self.act_totals = np.append(self.act_totals, 0.0)
+        return self.label_codes[label]
+
+    def append(self, tokens, values=None):
+        """
+        Adds rows for tokens, giving the tokens that aren't in the table yet a slot
+        :param tokens: List of tokens (class: Token)
+        :param values: Their values (array of shape (number of tokens, number of dimensions)),
+                       read from the tokens if not given
+        :return: None
+        """
+        m = len(tokens)
+        if m == 0:
+            return
+        if values is None:
+            values = np.asarray([[t.dimensions[dim] for dim in self.dims] for t in tokens],
+                                dtype=np.float64).reshape((m, len(self.dims)))
+        codes = np.asarray([self.code(t.label) for t in tokens], dtype=np.int32)
+
+        for t in tokens:
+            if t.table is not None and t.table is not self.table:
+                self.table.merge(t.table)
+        new = {id(t): t for t in tokens if t.table is None}
+        self.table.new_slots(list(new.values()))
+        # tokens of another table with a base get an independent slot here
+        foreign = {id(t): t for t in tokens if t.table is not self.table}
+        foreign = dict(zip(foreign.keys(), self.table.new_slots(list(foreign.values()), bind=False).tolist()))
+        slots = np.asarray([t.slot if t.table is self.table else foreign[id(t)] for t in tokens],
+                           dtype=np.int64)
+
+        n_entries = len(self.slot_tokens)
+        for i, (t, slot) in enumerate(zip(tokens, slots.tolist())):
+            if slot not in self.slot_of:
+                self.slot_of[slot] = len(self.slot_tokens)
+                self.slot_tokens.append(t)
+                self.slot_ids = grow(self.slot_ids, len(self.slot_tokens))
+                self.slot_rows = grow(self.slot_rows, len(self.slot_tokens))
+                self.slot_ids[len(self.slot_tokens) - 1] = slot
+                self.slot_rows[len(self.slot_tokens) - 1] = self.n + i
+        self.slot_counts = grow(self.slot_counts, len(self.slot_tokens))
+        self.slot_counts[n_entries:len(self.slot_tokens)] = 0
+        np.add.at(self.slot_counts, [self.slot_of[slot] for slot in slots.tolist()], 1)
+
+        self.values = grow(self.values, self.n + m)
+        self.codes = grow(self.codes, self.n + m)
+        self.slots = grow(self.slots, self.n + m)
+        self.values[self.n:self.n + m] = values
+        self.codes[self.n:self.n + m] = codes
+        self.slots[self.n:self.n + m] = slots
+        self.n += m
+
+        self.label_counts += np.bincount(codes, minlength=len(self.labels))
+        acts = self.table.get(slots)
+        np.add.at(self.act_sums, codes, acts[:, None] * values)
+        np.add.at(self.act_totals, codes, acts)
+        self.sums = self.sums + values.sum(axis=0)
+        self.outer = self.outer + values.T @ values
+
+    def moved(self, table, offset):
+        """
+        Follows the own rows' slots to the table they were merged into (see ActivationTable.merge())
+        :param table: New table
+        :param offset: Increase of the slots
+        :return: None
+        """
+        self.table = table
+        self.slots[:self.n] += offset
+        self.slot_ids[:len(self.slot_tokens)] += offset
+        self.slot_of = {slot + offset: entry for slot, entry in self.slot_of.items()}
+
+    def changed(self, slots, deltas):
+        """
+        Updates the activation-weighted sums after activation levels changed in the table
+        :param slots: Array of slots (without repetitions)
+        :param deltas: Array of the changes of their activation levels
+        :return: None
+        """
+        if len(slots) > len(self) // 4:
+            self.refresh_act_sums()
+            return
+
+        # every row of a changed token counts its new activation level
+        parts = []
+        if self.n_base > 0:
+            in_base = slots < self.table.n_base
+            base_slots = slots[in_base]
+            parts.append((deltas[in_base] * self.base_slot_counts[base_slots],
+                          self.table.base['codes'][base_slots], self.table.base['values'][base_slots]))
+        if self.slot_of:
+            entries = np.fromiter((self.slot_of.get(slot, -1) for slot in slots.tolist()),
+                                  dtype=np.int64, count=len(slots))
+            held = entries >= 0
+            rows = self.slot_rows[entries[held]]
+            parts.append((deltas[held] * self.slot_counts[entries[held]], self.codes[rows], self.values[rows]))
+        for weights, codes, values in parts:
+            np.add.at(self.act_sums, codes, weights[:, None] * values)
+            np.add.at(self.act_totals, codes, weights)
+
+    def count(self, label):
+        """
+        :param label: Label
+        :return: Number of tokens with the label
+        """
+        code = self.label_codes.get(label)
+        return 0 if code is None else int(self.label_counts[code])
+
+    def take(self, rows, base_array, own_array):
+        """
+        :param rows: Array of rows
+        :param base_array: Array of the base rows
+        :param own_array: Array of the own rows
+        :return: Array of the elements of the rows
+        """
+        in_base = rows < self.n_base
+        out = np.empty((len(rows),) + own_array.shape[1:], dtype=own_array.dtype)
+        out[in_base] = base_array[rows[in_base]]
+        out[~in_base] = own_array[rows[~in_base] - self.n_base]
+        return out
+
+    def codes_at(self, rows):
+        """
+        :param rows: Array of rows
+        :return: Label codes of the rows
+        """
+        return self.take(np.asarray(rows, dtype=np.int64), self.base_codes, self.codes)
+
+    def row_slots(self):
+        """
+        :return: Array of the table slots of all rows
+        """
+        return np.concatenate([self.base_slots, self.slots[:self.n]]).astype(np.int64)
+
+    def held_slots(self):
+        """
+        :return: Pair of arrays (table slots of the tokens, number of rows of each)
+        """
+        n_entries = len(self.slot_tokens)
+        if self.n_base == 0:
+            return self.slot_ids[:n_entries].copy(), self.slot_counts[:n_entries].copy()
+        base_slots = np.flatnonzero(self.base_slot_counts)
+        slots, inverse = np.unique(np.concatenate([base_slots, self.slot_ids[:n_entries]]),
+                                   return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([self.base_slot_counts[base_slots],
+                                                              self.slot_counts[:n_entries]]),
+                             minlength=len(slots))
+        return slots, counts
+
+    def segments(self):
+        """
+        :return: List of (values, label codes) of the base rows and of the own rows
+        """
+        return [(self.base_values, self.base_codes), (self.values[:self.n], self.codes[:self.n])]
+
+    def segment_acts(self):
+        """
+        :return: List of the activation levels of the base rows and of the own rows
+        """
+        return [self.table.get(self.base_slots), self.table.get(self.slots[:self.n])]
+
+    def distances(self, metric, point):
+        """
+        :param metric: Distance between tokens (class: Metric)
+        :param point: Array of values, aligned with self.dims
+        :return: Array of the distances of all rows from the point
+        """
+        parts = [chunked_kernels.distances(metric, values, point)
+                 for values, codes in self.segments() if len(values) > 0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.empty(0)
+
+    def select(self, columns, label=None, start=0, stop=None):
+        """
+        :param columns: Indices of dimensions
+        :param label: Only select tokens with this label (defaults to all tokens)
+        :param start: First row
+        :param stop: Row after the last one (defaults to all rows)
+        :return: Values of the selected tokens, in the given columns (a new array)
+        """
+        if stop is None:
+            stop = len(self)
+        parts = []
+        offset = 0
+        for values, codes in self.segments():
+            first, last = max(start - offset, 0), min(stop - offset, len(values))
+            offset += len(values)
+            if first >= last:
+                continue
+            part = values[first:last]
+            if label is not None:
+                part = part[codes[first:last] == self.label_codes.get(label, -1)]
+            parts.append(part[:, columns])
+        if not parts:
+            return np.empty((0, len(columns)))
+        return np.concatenate(parts)
+
+    def add_acts(self, rows, deltas):
+        """
+        Increases activation levels (of the tokens, in every representation holding them)
+        :param rows: Array of rows
+        :param deltas: Increments (array aligned with rows, or a number)
+        :return: None
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        self.table.add(self.take(rows, self.base_slots, self.slots), deltas)
+
+    def deactivate(self, amount):
+        """
+        Decreases activation levels by a fixed amount per row, with a floor of 0
+        :param amount: Decrease
+        :return: None
+        """
+        slots, counts = self.held_slots()
+        # a token with k rows is decreased k times
+        self.table.set(slots, chunked_kernels.deactivate(self.table.get(slots), amount * counts))
+
+    def refresh_act_sums(self):
+        """
+        Recomputes the activation-weighted sums per label
+        :return: None
+        """
+        self.act_sums[:] = 0.0
+        self.act_totals[:] = 0.0
+        for (values, codes), acts in zip(self.segments(), self.segment_acts()):
+            for code in range(len(self.labels)):
+                sums, total = chunked_kernels.weighted_sum(values, np.where(codes == code, acts, 0.0))
+                self.act_sums[code] += sums
+                self.act_totals[code] += total
+
+    def min_nonzero_act(self):
+        """
+        :return: Lowest non-zero activation level
+        """
+        acts = self.table.get(self.held_slots()[0])
+        return float(acts[acts != 0].min())
+
+    def weighted_sum(self, label):
+        """
+        :param label: Label
+        :return: Pair of (activation-weighted sum of the values of the tokens with the label,
+                 sum of their activation levels)
+        """
+        code = self.label_codes.get(label)
+        if code is None:
+            return np.zeros(len(self.dims)), 0.0
+        return self.act_sums[code], float(self.act_totals[code])
+
+    def base_token(self, values, code, slot):
+        """
+        :param values: List of the values of a base row
+        :param code: Its label code
+        :param slot: Its table slot
+        :return: New Token object for the row, reading and writing its slot
+        """
+        token = Token(t_dims=zip(self.dims, values), t_label=self.labels[code])
+        token.table, token.slot = self.table, slot
+        return token
+
+    def token_at(self, row):
+        """
+        :param row: Row
+        :return: The token of the row (class: Token, a new one for base rows)
+        """
+        if row < self.n_base:
+            return self.base_token(self.base_values[row].tolist(), int(self.base_codes[row]),
+                                   int(self.base_slots[row]))
+        return self.slot_tokens[self.slot_of[int(self.slots[row - self.n_base])]]
+
+    def base_tokens(self):
+        """
+        :return: List of new Token objects for the base rows
+        """
+        return [self.base_token(values, code, slot) for values, code, slot in
+                zip(self.base_values.tolist(), self.base_codes.tolist(), self.base_slots.tolist())]
+
+    def rows(self):
+        """
+        :return: Triplet of new arrays of the values, label codes and activation levels of all rows
+        """
+        (base_values, base_codes), (values, codes) = self.segments()
+        base_acts, acts = self.segment_acts()
+        return (np.concatenate([base_values, values]), np.concatenate([base_codes, codes]),
+                np.concatenate([base_acts, acts]))
+
+
 class Representation:
-    def __init__(self, n=None, dims=None, act=None, label=None):
+    def __init__(self, n=None, dims=None, act=None, label=None, rng=None):
         """
         Initializes a representation with a certain number of tokens,
         with a given number of dimensions with their distributions and activation level
@@ -81,6 +842,8 @@ class Representation:
                      ('name', mean, standard deviation)
         :param act: Starting activation of tokens
         :param label: Label of the representation
+        :param rng: Random number generator of the representation (class: numpy.random.Generator),
+                    defaults to a new, unseeded one
         """
         #list.__init__(self, [])
         if n is None:
@@ -103,10 +866,27 @@ class Representation:
         else:
             self.label = label
 
+        if rng is None:
+            self.rng = np.random.default_rng()
+        else:
+            self.rng = rng
+
         self.tokens=[]
+        # Read-only rows before the tokens, e.g. of a shared baseline (see TokenArrays)
+        self.base = None
+
+        # Distance settings (see set_metric()) and the cached arrays of the tokens (see token_arrays())
+        self.weights = None
+        self.scaling = None
+        self.cache = None
+
+        # Kernel density estimation settings (see set_kde())
+        self.bandwidth = 2.5
+        self.kde_atol = 0.0
+        self.kde_rtol = 1e-4
 
     def __str__(self):
-        elements = self.tokens
+        elements = self.all_tokens()
         meta = "Representation of category " + str(self.label) + " with " + str(len(elements)) + \
                " tokens\nDimensions: " + str(self.dimensions) + '\n'
 
@@ -119,30 +899,115 @@ class Representation:
         return meta + str(elements_str)
 
 
+    def set_metric(self, weights=None, scaling=None):
+        """
+        Sets how distances between tokens are measured (used by the activation functions
+        and closest_neighbors())
+        :param weights: Dictionary of weights per dimension name (missing dimensions have weight 1)
+        :param scaling: None (raw values), 'zscore' or 'mahalanobis' (see Metric)
+        :return: None, changes representation in place
+        """
+        if scaling not in SCALINGS:
+            raise ValueError('Unknown scaling: ' + str(scaling))
+        self.weights = weights
+        self.scaling = scaling
+        if self.cache is not None:
+            self.cache['metric'] = None
+
+    def token_arrays(self):
+        """
+        Values, labels and activation levels of the tokens (cached, and extended as tokens are
+        incorporated). Activation levels are kept in the ActivationTable of the tokens, shared
+        with the other representations holding them.
+        :return: TokenArrays, the rows of self.base followed by the rows of self.tokens
+        """
+        dims = list(self.dimensions.keys())
+        if self.cache is None or self.cache['tokens'] is not self.tokens or \
+                self.cache['dims'] != dims or len(self.tokens) < self.cache['arrays'].n:
+            self.cache = {'tokens': self.tokens, 'dims': dims, 'arrays': TokenArrays(dims, self.base),
+                          'metric': None, 'kernels': {}}
+
+        arrays = self.cache['arrays']
+        if len(self.tokens) > arrays.n:
+            arrays.append(self.tokens[arrays.n:])
+        return arrays
+
+    def all_tokens(self):
+        """
+        :return: List of all tokens, with new Token objects for the rows of self.base
+        """
+        if self.base is None:
+            return self.tokens
+        return self.token_arrays().base_tokens() + self.tokens
+
+    def metric(self):
+        """
+        :return: Distance between tokens (class: Metric), fitted to the tokens
+        """
+        arrays = self.token_arrays()
+        if self.cache['metric'] is None:
+            self.cache['metric'] = Metric(arrays.dims, self.weights, self.scaling)
+        metric = self.cache['metric']
+        if metric.n != len(arrays):
+            metric.set_moments(len(arrays), arrays.sums, arrays.outer)
+        return metric
+
+    def distances(self, input_token):
+        """
+        Distances of all tokens from the input token
+        :param input_token: Input token (class: Token)
+        :return: Array of distances, aligned with the rows of self.token_arrays()
+        """
+        metric = self.metric()
+        return self.token_arrays().distances(metric, metric.vector(input_token))
+
+    def nearest(self, input_token, k):
+        """
+        Indices of the k tokens closest to the input token
+        :param input_token: Input token (class: Token)
+        :param k: Number of tokens
+        :return: Pair of arrays (rows of self.token_arrays(), distances), closest first
+        """
+        dists = self.distances(input_token)
+        # Ties are broken by the order of the tokens
+        indices = chunked_kernels.top_k(dists, k)
+
+        return indices, dists[indices]
+
+
     def update_meta(self):
         """
-        Updates the attributes automatically based on the properties of the set.
+        Updates the attributes automatically based on the properties of the set
+        (from the running moments of the tokens' values).
         :return: None, changes representation in place
         """
-        for dim in self.dimensions.keys():
-            self.dimensions[dim] = (stats.mean([token.dimensions[dim] for token in self.tokens]),
-                                    stats.stdev([token.dimensions[dim] for token in self.tokens]))
-        self.n = len(self.tokens)
+        arrays = self.token_arrays()
+        n = len(arrays)
+        if n < 2:
+            raise stats.StatisticsError('variance requires at least two data points')
+        means = arrays.sums / n
+        variances = (np.diag(arrays.outer) - n * means ** 2) / (n - 1)
+        for d, dim in enumerate(arrays.dims):
+            self.dimensions[dim] = (float(means[d]), math.sqrt(max(float(variances[d]), 0.0)))
+        self.n = n
 
     def populate(self):
         """
         Populates a set with the required number of tokens of desired distribution.
         :return: None, changes representation in place
         """
+        means = [v[0] for v in self.dimensions.values()]
+        sds = [v[1] for v in self.dimensions.values()]
+        values = self.rng.normal(means, sds, size=(self.n, len(means)))
+        arrays = self.token_arrays()
+        new_tokens = []
         for i in range(self.n):
-            dims_for_token = ((dim, random.gauss(v[0], v[1])) for (dim, v) in self.dimensions.items())
+            dims_for_token = zip(self.dimensions.keys(), values[i].tolist())
             t = Token(t_dims=dims_for_token, t_act=self.starting_act, t_label=self.label)
 
-            t.dimensions = {dim: random.gauss(v[0], v[1]) for dim, v in self.dimensions.items()}
-            t.act = self.starting_act
-            t.label = self.label
-
-            self.tokens.append(t)
+            new_tokens.append(t)
+        self.tokens.extend(new_tokens)
+        arrays.append(new_tokens, values)
         self.update_meta()
 
 
@@ -153,9 +1018,14 @@ class Representation:
         :param f: Number of elements to delete from representation
         :return: None, changes representation in place
         """
-        random.shuffle(self)
+        if self.base is not None:
+            # the base rows become tokens of the representation
+            self.tokens = self.all_tokens()
+            self.base = None
+        self.tokens[:] = [self.tokens[i] for i in self.rng.permutation(len(self.tokens))]
         for i in range(f):
             popped = self.tokens.pop()
+        self.cache = None
         self.update_meta()
 
 
@@ -178,7 +1048,9 @@ class Representation:
         """
         if starting_act is None:
             starting_act = self.starting_act
-        activated = [act_t for act_t in self.tokens if act_t.act != 0 and act_t.label == label]
+        # Activation-weighted sum of the tokens with the label (kept up to date by TokenArrays)
+        arrays = self.token_arrays()
+        sums, total = arrays.weighted_sum(label)
         token = Token()
         token.dimensions={}
         if label == None:
@@ -186,17 +1058,15 @@ class Representation:
         else:
             token.label = label
 
-        try:
-            for dim in self.dimensions.keys():
-                token.dimensions[dim] = sum([token.dimensions[dim] * token.act for token in activated]) /\
-                             sum([token.act for token in activated]) + (random.random() *
-                                                                        random.choice([-2, -1, 1, 2]))
-                # token['eucl'] = abs(reduce(lambda x, y: x * y, token.values()))
-
-                token.act = starting_act
-            return token
-        except ZeroDivisionError:
+        if total == 0:
             print('You have no activated tokens')
+            return None
+
+        for d, dim in enumerate(arrays.dims):
+            token.dimensions[dim] = float(sums[d] / total + (self.rng.random() *
+                                                             self.rng.choice([-2, -1, 1, 2])))
+        token.act = starting_act
+        return token
 
 
 
@@ -206,19 +1076,22 @@ class Representation:
         as the initial representation (left-join)
         :param other_rep: The representation to combine with self
         :return: New representation with a potentially multimodal distribution
+                 (its random number generator is spawned from self's)
         """
         new_rep = Representation(n=self.n+other_rep.n,
-                                 act=None)
+                                 act=None, rng=spawn_rngs(self.rng, 1)[0])
         new_rep.dimensions={dim_k: (self.dimensions[dim_k][0],
                                     self.dimensions[dim_k][1])
                             for dim_k in self.dimensions.keys()}
-        new_rep.tokens = self.tokens + other_rep.tokens
+        new_rep.tokens = self.all_tokens() + other_rep.all_tokens()
 
         if self.label == other_rep.label:
             new_rep.label = self.label
         else:
             new_rep.label = self.label + "AND" + other_rep.label
 
+        new_rep.set_metric(self.weights, self.scaling)
+        new_rep.set_kde(self.bandwidth, self.kde_atol, self.kde_rtol)
         new_rep.update_meta()
 
         return new_rep
@@ -227,14 +1100,16 @@ class Representation:
         """
         Returns a representation, with all the tokens from the bigger representation with a given label
         :param label: Label to filter by
-        :return: Representation
+        :return: Representation (its random number generator is spawned from self's)
         """
-        new_rep = Representation(label=label)
+        new_rep = Representation(label=label, rng=spawn_rngs(self.rng, 1)[0])
         new_rep.dimensions = {dim_k: (self.dimensions[dim_k][0],
                                       self.dimensions[dim_k][1])
                               for dim_k in self.dimensions.keys()}
-        new_rep.tokens = [t for t in self.tokens if t.label==label]
+        new_rep.tokens = [t for t in self.all_tokens() if t.label==label]
 
+        new_rep.set_metric(self.weights, self.scaling)
+        new_rep.set_kde(self.bandwidth, self.kde_atol, self.kde_rtol)
         new_rep.update_meta()
 
         return new_rep
@@ -248,11 +1123,9 @@ class Representation:
         :return: List of k closest neighbors (integer)
         """
 
-        self.tokens.sort(key=lambda t: distance.euclidean(
-            [v for k, v in t.dimensions.items()],
-            [v for k, v in input_token.dimensions.items()]))
-
-        neighbors = self.tokens[:k]
+        indices, dists = self.nearest(input_token, k)
+        arrays = self.token_arrays()
+        neighbors = [arrays.token_at(i) for i in indices]
 
         return neighbors
 
@@ -274,54 +1147,125 @@ class Representation:
         return m
 
 
-    def fit_kernel(self, dimname, value):
-        #bw = (self.n * 3/4) ** (-1 / 5)
-        #bw = self.n ** (-1/5)
-        #print(bw)
-        bw= 2.5
-
-        # fit density
-        obs_values= np.asarray([t.dimensions[dimname] for t in self.tokens])
-        model = KernelDensity(bandwidth=bw, kernel='gaussian')
-        obs_values = obs_values.reshape((len(obs_values), 1))
-        model.fit(obs_values)
-
-        # sample probabilities for a range of outcomes
-        #poss_values = np.asarray([value for value in range(minvalue, maxvalue)])
-        value_format = np.asarray([value])
-        value_format = value_format.reshape((len(value_format), 1))
-        probability = model.score_samples(value_format)[0]
-        probability = np.exp(probability)
-
-        # plot the histogram and pdf
-        #pyplot.hist(obs_values, bins=100, density=True)
-        #poss_values = np.asarray([value for value in range(0, 200)])
-        #poss_values = poss_values.reshape((len(poss_values), 1))
-        #probabilities = model.score_samples(poss_values)
-        #probabilities = np.exp(probabilities)
-        #pyplot.plot(poss_values[:], probabilities)
-        #pyplot.show()
-
-        return probability
+    def set_kde(self, bandwidth=2.5, atol=0.0, rtol=1e-4):
+        """
+        Sets the kernel density estimation behind fit_kernel() and bayesian_prob()
+        :param bandwidth: Bandwidth of the Gaussian kernel
+        :param atol: Absolute error tolerance of the tree-based estimate
+        :param rtol: Relative error tolerance of the tree-based estimate (0 for exact estimates)
+        :return: None, changes representation in place
+        """
+        self.bandwidth = bandwidth
+        self.kde_atol = atol
+        self.kde_rtol = rtol
+        if self.cache is not None:
+            self.cache['kernels'] = {}
 
+    def dim_list(self, dims):
+        """
+        :param dims: Name of a dimension, list of names, or None for all dimensions
+        :return: List of dimension names
+        """
+        if dims is None:
+            return list(self.dimensions.keys())
+        if isinstance(dims, str):
+            return [dims]
+        return list(dims)
 
+    def kde_tree(self, obs_values, stop):
+        """
+        Builds the k-d tree of a kernel density estimate
+        :param obs_values: Values of the tokens (array of shape (number of tokens, number of dimensions))
+        :param stop: Row after the last token in the tree
+        :return: Dictionary of the tree ('tree', None if there are no tokens),
+                 the number of tokens ('n') and 'stop'
+        """
+        tree = None
+        if len(obs_values) > 0:
+            tree = KDTree(obs_values, leaf_size=KDE_LEAF_SIZE)
+        return {'tree': tree, 'n': len(obs_values), 'stop': stop}
 
-    def bayesian_prob(self, new_token, dim):
+    def fit_kernel(self, dimname, value, label=None):
+        """
+        Kernel density of a value, jointly over one or more dimensions.
+        The k-d tree of the estimate is kept between calls: tokens incorporated since it was
+        built are added to the estimate exactly, and the tree is rebuilt once they make up
+        more than KDE_REFIT_FRACTION of the tokens. The base rows have a tree of their own,
+        shared by the representations on top of the same base, which is never rebuilt.
+        :param dimname: Name of a dimension, list of names, or None for all dimensions
+        :param value: Value (or list of values, aligned with dimname) to estimate the density at
+        :param label: Only use tokens of this label (defaults to all tokens)
+        :return: Probability density (float)
+        """
+        #bw = (self.n * 3/4) ** (-1 / 5)
+        #bw = self.n ** (-1/5)
+        bw = self.bandwidth
+        dims = self.dim_list(dimname)
+        arrays = self.token_arrays()
+        columns = [arrays.dims.index(dim) for dim in dims]
+        point = np.asarray(value, dtype=np.float64).reshape((1, len(dims)))
+
+        key = (tuple(dims), label)
+        kernels = []
+        if arrays.n_base > 0:
+            # e.g. built once, by the process that stored the base (see shared_baseline.py)
+            base_key = key + (bw, self.kde_atol, self.kde_rtol)
+            base_kernel = arrays.base_kernels.get(base_key)
+            if base_kernel is None:
+                base_kernel = self.kde_tree(arrays.select(columns, label, stop=arrays.n_base), arrays.n_base)
+                arrays.base_kernels[base_key] = base_kernel
+            kernels.append(base_kernel)
+
+        kernel = self.cache['kernels'].get(key)
+        if kernel is None or len(arrays) - kernel['stop'] > \
+                KDE_REFIT_FRACTION * max(sum(k['n'] for k in kernels) + kernel['n'], 1):
+            kernel = self.kde_tree(arrays.select(columns, label, arrays.n_base), len(arrays))
+            self.cache['kernels'][key] = kernel
+        kernels.append(kernel)
+
+        # Tokens incorporated since the tree was built
+        pending = arrays.select(columns, label, kernel['stop'])
+        n = sum(k['n'] for k in kernels) + len(pending)
+        if n == 0:
+            return 0.0
+
+        # Sum of the kernels of the tokens (the tolerances are those of KernelDensity)
+        probability = 0.0
+        for k in kernels:
+            if k['tree'] is not None:
+                probability += k['tree'].kernel_density(point, h=bw, kernel='gaussian',
+                                                        atol=self.kde_atol * k['n'], rtol=self.kde_rtol,
+                                                        breadth_first=True)[0]
+        if len(pending) > 0:
+            sq_dists = ((pending - point) ** 2).sum(axis=1)
+            probability += np.exp(-0.5 * sq_dists / bw ** 2).sum() / \
+                (2 * math.pi * bw ** 2) ** (len(dims) / 2)
+
+        return probability / n
+
+    def bayesian_prob(self, new_token, dim=None):
+        """
+        Probability of the new token's label given its values (Bayes' theorem, with
+        kernel density estimates), jointly over one or more dimensions
+        :param new_token: Token (class: Token)
+        :param dim: Name of a dimension, list of names, or None for all dimensions
+        :return: Probability (float)
+        """
         label = new_token.label
-        value = new_token.dimensions[dim]
-
-        others_with_lab = self.filter_by_label(label)
+        dims = self.dim_list(dim)
+        value = [new_token.dimensions[d] for d in dims]
 
-        p_lab = len(others_with_lab.tokens) / len(self.tokens)
-        p_value = self.fit_kernel(dim, value)
-        p_of_value_within_lab = others_with_lab.fit_kernel(dim, value)
+        arrays = self.token_arrays()
+        p_lab = arrays.count(label) / len(arrays)
+        p_value = self.fit_kernel(dims, value)
+        p_of_value_within_lab = self.fit_kernel(dims, value, label)
 
-        bayesian = (p_lab * p_of_value_within_lab) / p_value
+        # The two estimates are approximate, their ratio can exceed 1
+        bayesian = min((p_lab * p_of_value_within_lab) / p_value, 1.0)
 
         return bayesian
 
 
-
     # Activation functions
     def activate_1(self, new_token, n, added_act):
         """
@@ -333,13 +1277,10 @@ class Representation:
         :param added_act: How much to increment activation levels by
         :return: None, changes representation in place
         """
-        # Sort exemplars by their distance from the new token
-        self.tokens.sort(key=lambda t: distance.euclidean(
-            [v for k, v in t.dimensions.items()],
-            [v for k, v in new_token.dimensions.items()]))
+        # Find the n exemplars closest to the new token
+        indices, dists = self.nearest(new_token, n)
         # Modify the first n token's activation levels
-        for i in range(n):
-            self.tokens[i].act += added_act
+        self.token_arrays().add_acts(indices, added_act)
 
 
     def activate_2(self, new_token):
@@ -351,13 +1292,8 @@ class Representation:
         :param new_token: New token that causes activation
         :return: None, changes representation in place
         """
-        for t in self.tokens:
-            dist = distance.euclidean(
-                [v for k, v in t.dimensions.items()],
-                [v for k, v in new_token.dimensions.items()])
-            if dist == 0:
-                dist = 0.001
-            t.act += proportionate_inverse(dist)
+        dists = self.distances(new_token)
+        self.token_arrays().add_acts(np.arange(len(dists)), vec_proportionate_inverse(dists, 0.001))
 
 
     def activate_3(self, new_token, n):
@@ -371,18 +1307,10 @@ class Representation:
         :param n: Number of tokens to activate
         :return: None, changes representation in place
         """
-        # Sort exemplars by their distance from the new token
-        self.tokens.sort(key=lambda t: distance.euclidean(
-            [v for k, v in t.dimensions.items()],
-            [v for k, v in new_token.dimensions.items()]))
+        # Find the n exemplars closest to the new token
+        indices, dists = self.nearest(new_token, n)
         # Modify the closest n exemplar's activation level
-        for i in range(n):
-            dist = distance.euclidean(
-                [v for k, v in self.tokens[i].dimensions.items()],
-                [v for k, v in new_token.dimensions.items()])
-            if dist == 0:
-                dist = 0.1
-            self.tokens[i].act += proportionate_inverse(dist)
+        self.token_arrays().add_acts(indices, vec_proportionate_inverse(dists, 0.1))
 
 
     def activate_4(self, new_token, n, coeff):
@@ -397,19 +1325,12 @@ class Representation:
         :param coeff: Coefficient for degree of activation
         :return: None, changes representation in place
         """
-        # Sort exemplars by their distance from the new token
-        self.tokens.sort(key=lambda t: distance.euclidean(
-            [v for k, v in t.dimensions.items()],
-            [v for k, v in new_token.dimensions.items()]))
-        # Modify the closest n exemplar's activation level
-        for i in range(n):
-            dist = distance.euclidean(
-                [v for k, v in self.tokens[i].dimensions.items()],
-                [v for k, v in new_token.dimensions.items()])
-            if dist == 0:
-                dist = 0.1
-            if new_token.label == self.tokens[i].label:
-                self.tokens[i].act += proportionate_inverse(dist) * coeff
+        # Find the n exemplars closest to the new token
+        indices, dists = self.nearest(new_token, n)
+        # Modify the closest n exemplar's activation level (tokens with the new token's label)
+        arrays = self.token_arrays()
+        same = arrays.codes_at(indices) == arrays.label_codes.get(new_token.label, -1)
+        arrays.add_acts(indices[same], vec_proportionate_inverse(dists[same], 0.1) * coeff)
 
 
     # Deactivation functions: fixed and flexible
@@ -420,11 +1341,7 @@ class Representation:
         :param amount: Decrease to be implemented
         :return: None, changes representation in place
         """
-        for token in self.tokens:
-            if token.act > amount:
-                token.act -= amount
-            else:
-                token.act = 0
+        self.token_arrays().deactivate(amount)
 
 
     def deactivate_flex(self):
@@ -433,18 +1350,17 @@ class Representation:
         by the amount of the lowest non-zero activation level.
         :return: None, changes representation in place
         """
-        act_levels = {token.act for token in self.tokens if token.act != 0}
-        self.deactivate_fix(min(act_levels))
+        self.deactivate_fix(self.token_arrays().min_nonzero_act())
 
 
 
 # Debugging
 if __name__ == '__main__':
-    random.seed(0)
-    rep1 = Representation(n=50, dims=[('dummy_d', 10, 0.5)], act=0.1, label="foo")
+    rng1, rng2 = spawn_rngs(np.random.default_rng(0), 2)
+    rep1 = Representation(n=50, dims=[('dummy_d', 10, 0.5)], act=0.1, label="foo", rng=rng1)
     rep1.populate()
 
-    rep2 = Representation(n=15, dims=[('dummy_d', 100, 0.5)], act=0.1, label="bar")
+    rep2 = Representation(n=15, dims=[('dummy_d', 100, 0.5)], act=0.1, label="bar", rng=rng2)
     rep2.populate()
 
     rep_sum = rep1.combine(rep2)
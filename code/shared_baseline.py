@@ -0,0 +1,318 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Sharing a speaker's baseline            ##
+## representations between sweep workers  ##
+############################################
+
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from representation_token_class import ActivationTable, Representation, Token, spawn_rngs, summaries
+from acc_simulation import build_speaker, shadow
+
+
+def _share(array, blocks, key):
+    """
+    Copies an array into a new shared memory block
+    :param array: Array
+    :param blocks: Dictionary of shared memory blocks to add the block to
+    :param key: Key of the block in blocks
+    :return: Description of the block (name, shape, dtype)
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    blocks[key] = shm
+    return shm.name, array.shape, array.dtype
+
+
+def _view(shm, shape, dtype):
+    """
+    :return: Read-only array backed by a shared memory block
+    """
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return array
+
+
+def _share_tree(tree, blocks, name, key):
+    """
+    Copies the arrays of a k-d tree into new shared memory blocks
+    :param tree: k-d tree (class: sklearn.neighbors.KDTree)
+    :param blocks: Dictionary of shared memory blocks to add the blocks to
+    :param name: Name of the representation of the tree
+    :param key: Name of the tree
+    :return: List of the tree's state: descriptions of the blocks of its arrays, and its other values
+    """
+    return [('block', _share(item, blocks, (name, key + str(i)))) if isinstance(item, np.ndarray)
+            else ('value', item)
+            for i, item in enumerate(tree.__getstate__())]
+
+
+def _tree_view(state, blocks, name, key):
+    """
+    :return: k-d tree (class: sklearn.neighbors.KDTree) whose arrays are backed by
+             the shared memory blocks of _share_tree(), without copying them
+    """
+    tree = KDTree.__new__(KDTree)
+    tree.__setstate__(tuple(_view(blocks[(name, key + str(i))], *item[1:]) if kind == 'block' else item
+                            for i, (kind, item) in enumerate(state)))
+    return tree
+
+
+def _block_names(spec):
+    """
+    :param spec: The .spec attribute of a SharedBaseline
+    :return: Dictionary of the names of its shared memory blocks, by key (see SharedBaseline)
+    """
+    names = {(None, key): block[0] for key, block in spec['blocks'].items()}
+    for name, rep_spec in spec['reps'].items():
+        names.update({(name, key): block[0] for key, block in rep_spec['blocks'].items()})
+        for i, (base_key, n, state) in enumerate(rep_spec['kernels']):
+            names.update({(name, 'kernel{}_{}'.format(i, j)): item[0]
+                          for j, (kind, item) in enumerate(state) if kind == 'block'})
+    return names
+
+
+class SharedBaseline:
+    def __init__(self, spec, blocks):
+        """
+        Read-only view of baseline representations stored in shared memory.
+        Use SharedBaseline.create() to store representations, and
+        SharedBaseline.attach() to access them from another process.
+        :param spec: Description of the stored representations (picklable dictionary)
+        :param blocks: Dictionary of shared memory blocks ((representation name, array name): SharedMemory,
+                       with None instead of a representation name for the arrays of the tokens)
+        """
+        self.spec = spec
+        self.blocks = blocks
+        self.dims = spec['dims']
+        self.labels = spec['labels']
+
+        # Starting activation levels, values and label codes of the tokens (the base of the forks'
+        # ActivationTables, see representation_token_class.py)
+        self.table_base = {key: _view(blocks[(None, key)], shape, dtype)
+                           for key, (block_name, shape, dtype) in spec['blocks'].items()}
+
+        # Base rows of the forks' representations (see representation_token_class.TokenArrays),
+        # with the k-d trees of their kernel density estimates shared by the forks of this process
+        # (those over all dimensions are built by create() and read from shared memory)
+        self.bases = {}
+        for name, rep_spec in spec['reps'].items():
+            base = {'labels': self.labels, 'summaries': rep_spec['summaries'], 'kernels': {}}
+            for key, (block_name, shape, dtype) in rep_spec['blocks'].items():
+                base[key] = _view(blocks[(name, key)], shape, dtype)
+            for i, (base_key, n, state) in enumerate(rep_spec['kernels']):
+                base['kernels'][base_key] = {'tree': _tree_view(state, blocks, name, 'kernel{}_'.format(i)),
+                                             'n': n, 'stop': rep_spec['n']}
+            self.bases[name] = base
+
+    @classmethod
+    def create(cls, reps):
+        """
+        Stores representations in shared memory. Tokens held by more than one representation
+        (e.g. after Representation.combine()) are stored once, with one activation level,
+        so that the representations of a fork share activation levels like the originals do.
+        The k-d trees of the representations' kernel density estimates over all dimensions
+        (for all tokens, and for the tokens of each label) are built here once, and stored too.
+        :param reps: Dictionary of representations (name: Representation)
+        :return: SharedBaseline, owning the shared memory blocks
+        """
+        dims = list(next(iter(reps.values())).dimensions.keys())
+        rows = {name: rep.token_arrays() for name, rep in reps.items()}
+        labels = sorted({label for arrays in rows.values() for label in arrays.labels})
+        label_positions = {label: i for i, label in enumerate(labels)}
+
+        # One slot per token: the slots of the representations' ActivationTables, numbered anew
+        tables = {}
+        for name, arrays in rows.items():
+            tables.setdefault(id(arrays.table), (arrays.table, []))[1].append(name)
+        rep_arrays = {}
+        token_arrays = {'acts': [], 'values': [], 'codes': []}
+        n_slots = 0
+        for table, names in tables.values():
+            table_slots = [rows[name].row_slots() for name in names]
+            slots, first, inverse = np.unique(np.concatenate(table_slots), return_index=True,
+                                              return_inverse=True)
+            start = 0
+            values, codes = [], []
+            for name, name_slots in zip(names, table_slots):
+                rep_values, rep_codes, rep_acts = rows[name].rows()
+                rep_codes = np.asarray([label_positions[label] for label in rows[name].labels],
+                                       dtype=np.int32)[rep_codes]
+                rep_arrays[name] = {'values': rep_values, 'codes': rep_codes,
+                                    'slots': n_slots + inverse[start:start + len(name_slots)]}
+                values.append(rep_values)
+                codes.append(rep_codes)
+                start += len(name_slots)
+            token_arrays['acts'].append(table.get(slots))
+            token_arrays['values'].append(np.concatenate(values)[first])
+            token_arrays['codes'].append(np.concatenate(codes)[first])
+            n_slots += len(slots)
+        token_arrays = {key: np.concatenate(parts) for key, parts in token_arrays.items()}
+
+        blocks = {}
+        spec = {'dims': dims, 'labels': labels, 'reps': {}, 'blocks': {}}
+        for key, array in token_arrays.items():
+            spec['blocks'][key] = _share(array, blocks, (None, key))
+        for name, rep in reps.items():
+            arrays = rep_arrays[name]
+            arrays['slot_counts'] = np.bincount(arrays['slots'], minlength=n_slots)
+            rep_spec = {'n': len(arrays['values']),
+                        'label': rep.label,
+                        'starting_act': rep.starting_act,
+                        'dimensions': dict(rep.dimensions),
+                        'kde': (rep.bandwidth, rep.kde_atol, rep.kde_rtol),
+                        'summaries': summaries(arrays['values'], arrays['codes'],
+                                               token_arrays['acts'][arrays['slots']], len(labels)),
+                        'blocks': {},
+                        'kernels': []}
+            for key, array in arrays.items():
+                rep_spec['blocks'][key] = _share(array, blocks, (name, key))
+            # the keys are those of Representation.fit_kernel()
+            for label in [None] + labels:
+                values = arrays['values']
+                if label is not None:
+                    values = values[arrays['codes'] == label_positions[label]]
+                kernel = rep.kde_tree(values, len(arrays['values']))
+                if kernel['tree'] is None:
+                    continue
+                key = 'kernel{}_'.format(len(rep_spec['kernels']))
+                rep_spec['kernels'].append(((tuple(dims), label) + rep_spec['kde'], kernel['n'],
+                                            _share_tree(kernel['tree'], blocks, name, key)))
+            spec['reps'][name] = rep_spec
+
+        return cls(spec, blocks)
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Accesses representations stored by SharedBaseline.create() from a worker process
+        :param spec: The .spec attribute of the SharedBaseline that created them
+        :return: SharedBaseline
+        """
+        blocks = {key: shared_memory.SharedMemory(name=block_name)
+                  for key, block_name in _block_names(spec).items()}
+        return cls(spec, blocks)
+
+    def fork(self, rng=None):
+        """
+        Creates private, modifiable representations on top of the shared baseline.
+        They read the baseline's values, labels, activation levels and k-d trees from shared memory;
+        new tokens and changed activation levels are kept privately, by the fork, in one
+        ActivationTable shared by its representations (a private copy of all the baseline's
+        activation levels once more than an eighth of them changed, see ActivationTable).
+        :param rng: Random number generator of the fork (class: numpy.random.Generator),
+                    every representation gets its own stream spawned from it
+                    (defaults to a new, unseeded one)
+        :return: Dictionary of representations (name: Representation)
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        reps = {}
+        table = ActivationTable(self.table_base)
+        rngs = spawn_rngs(rng, len(self.spec['reps']))
+        for (name, rep_spec), rep_rng in zip(self.spec['reps'].items(), rngs):
+            rep = Representation(act=rep_spec['starting_act'], label=rep_spec['label'], rng=rep_rng)
+            rep.dimensions = dict(rep_spec['dimensions'])
+            rep.set_kde(*rep_spec['kde'])
+            rep.base = dict(self.bases[name], table=table)
+            rep.n = rep_spec['n']
+            reps[name] = rep
+
+        return reps
+
+    def close(self):
+        """
+        Closes this process' access to the shared memory blocks
+        :return: None
+        """
+        self.bases = None
+        self.table_base = None
+        for shm in self.blocks.values():
+            shm.close()
+
+    def unlink(self):
+        """
+        Frees the shared memory blocks (to be called once, by the creating process)
+        :return: None
+        """
+        for shm in self.blocks.values():
+            shm.unlink()
+
+
+# Baseline of the current sweep worker process
+_worker_baseline = None
+
+
+def _init_worker(spec):
+    global _worker_baseline
+    _worker_baseline = SharedBaseline.attach(spec)
+
+
+def _run_job(job):
+    """
+    Runs a shadowing task on a fork of the worker's baseline
+    :param job: Dictionary with the names of the stimulus category ('cat') and of the combined
+                representation ('reps'), the interlocutor's token ('token'), the seed of the
+                job's random number generator ('seed': integer or numpy.random.SeedSequence),
+                and any further keyword arguments to shadow()
+    :return: List of the dimensions of the produced tokens
+    """
+    job = dict(job)
+    speaker = _worker_baseline.fork(np.random.default_rng(job.pop('seed')))
+    trajectory = shadow(speaker[job.pop('cat')], speaker[job.pop('reps')], job.pop('token'), **job)
+    return [t.dimensions for t in trajectory]
+
+
+def run_sweep(baseline, jobs, processes=None, seed=None):
+    """
+    Runs shadowing tasks in parallel, every worker forking the same shared baseline.
+    Jobs without a seed get one spawned from seed, so the results don't depend on
+    which worker runs which job, or in what order.
+    :param baseline: The baseline speaker (class: SharedBaseline)
+    :param jobs: List of jobs (see _run_job())
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param seed: Seed of the sweep (defaults to a random one)
+    :return: List of production trajectories, in the order of the jobs
+    """
+    job_seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+    jobs = [dict(job, seed=job.get('seed', job_seed)) for job, job_seed in zip(jobs, job_seeds)]
+    with Pool(processes=processes, initializer=_init_worker, initargs=(baseline.spec,)) as pool:
+        return pool.map(_run_job, jobs)
+
+
+# Debugging
+if __name__ == '__main__':
+    baseline = SharedBaseline.create(build_speaker('F08', rng=np.random.default_rng(1)))
+
+    stimuli = [Token(t_dims=[('VOT', 15)], t_label='p'),
+               Token(t_dims=[('VOT', 130)], t_label='p'),
+               Token(t_dims=[('VOT', -130)], t_label='b'),
+               Token(t_dims=[('VOT', 15)], t_label='b')]
+    jobs = [{'cat': i_token.label, 'reps': 'all', 'token': i_token, 'max_iter': 20}
+            for i_token in stimuli for replica in range(4)]
+    try:
+        trajectories = run_sweep(baseline, jobs, seed=1)
+        #[print(job['token'], [d['VOT'] for d in tr]) for job, tr in zip(jobs, trajectories)]
+    finally:
+        baseline.close()
+        baseline.unlink()
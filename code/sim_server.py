@@ -0,0 +1,272 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2018 Ildiko Emese Szabo
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+############################################
+## Local simulation server keeping        ##
+## populated speakers warm in memory      ##
+############################################
+
+# Requests and responses are JSON:
+#   GET  /speakers  lists the warm speakers
+#   POST /speakers  {"name": "F08", "profile": "F08" or a profile, "seed": 1}
+#                   populates a new speaker (see acc_simulation.build_speaker())
+#   POST /shadow    {"speaker": "F08", "cat": "p", "reps": "all",
+#                    "token": {"dims": {"VOT": 15}, "label": "p"},
+#                    "seed": 1, "max_iter": 20, "n_act": 100, "window": 5, "tol": 1.0}
+#                   runs a shadowing task on a fork of the speaker,
+#                   returns the produced tokens' dimensions under "trajectory"
+
+import argparse
+import json
+import os
+import socketserver
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from representation_token_class import Token
+from acc_simulation import SPEAKER_PROFILES, build_speaker, shadow
+from shared_baseline import SharedBaseline
+
+
+# Keyword arguments of shadow() that can be set in a request
+SHADOW_OPTIONS = ('n_act', 'max_iter', 'window', 'tol')
+
+# Largest max_iter a request can ask for (see --max-iter)
+MAX_ITER = 200
+
+
+def is_int(value):
+    # JSON true and false are bools, which are ints in Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SimulationService:
+    def __init__(self, max_iter=MAX_ITER):
+        """
+        Keeps named, populated speakers in memory. Simulations run on forks of them,
+        one at a time, in the order the requests arrived.
+        :param max_iter: Largest number of iterations a request can ask for
+        """
+        self.speakers = {}
+        self.max_iter = max_iter
+        self.queue = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, func, *args):
+        """
+        Queues a call and waits for its result
+        :param func: Function to call
+        :return: Return value of func
+        """
+        return self.queue.submit(func, *args).result()
+
+    def describe(self):
+        """
+        :return: Dictionary of the warm speakers and their representations
+        """
+        return {name: {rep_name: {'label': rep_spec['label'],
+                                  'n': rep_spec['n'],
+                                  'dimensions': rep_spec['dimensions']}
+                       for rep_name, rep_spec in baseline.spec['reps'].items()}
+                for name, baseline in list(self.speakers.items())}
+
+    def add_speaker(self, name, profile, seed=None):
+        """
+        Populates a speaker and keeps it in memory
+        :param name: Name of the speaker
+        :param profile: Name of a profile in SPEAKER_PROFILES, or a profile of the same form
+        :param seed: Random seed for populating the speaker
+        :return: None
+        """
+        baseline = SharedBaseline.create(build_speaker(profile, rng=np.random.default_rng(seed)))
+        if name in self.speakers:
+            self.remove_speaker(name)
+        self.speakers[name] = baseline
+
+    def remove_speaker(self, name):
+        """
+        Frees the memory of a speaker
+        :param name: Name of the speaker
+        :return: None
+        """
+        baseline = self.speakers.pop(name)
+        baseline.close()
+        baseline.unlink()
+
+    def check_shadow(self, request):
+        """
+        Checks a /shadow request before it is queued
+        :param request: Dictionary, see the /shadow request above
+        :return: None, raises ValueError if the request can't be run
+        """
+        for key in ('n_act', 'max_iter', 'window'):
+            if key in request and not (is_int(request[key]) and request[key] > 0):
+                raise ValueError(key + ' has to be a positive integer')
+        if request.get('tol') is not None and not is_number(request['tol']):
+            raise ValueError('tol has to be a number or null')
+        if request.get('seed') is not None and not (is_int(request['seed']) and request['seed'] >= 0):
+            raise ValueError('seed has to be a non-negative integer or null')
+        token = request['token']
+        dims = self.speakers[request['speaker']].dims
+        if not isinstance(token, dict) or not isinstance(token.get('dims'), dict) or \
+                sorted(token['dims']) != sorted(dims) or \
+                not all(is_number(value) for value in token['dims'].values()):
+            raise ValueError('token has to be of the form {"dims": {' +
+                             ', '.join('"' + dim + '": value' for dim in dims) + '}, "label": label}')
+
+        reps = self.speakers[request['speaker']].spec['reps']
+        label = request['token']['label']
+        cat = request.get('cat', label)
+        for name in (cat, request.get('reps', 'all')):
+            if name not in reps:
+                raise ValueError('Unknown representation: ' + str(name))
+        # The speaker produces tokens of the label from the category's tokens
+        labels = self.speakers[request['speaker']].labels
+        if label not in labels or reps[cat]['summaries']['label_counts'][labels.index(label)] == 0:
+            raise ValueError('No tokens labelled ' + str(label) + ' in ' + str(cat))
+        if request.get('max_iter', 20) > self.max_iter:
+            raise ValueError('max_iter is limited to ' + str(self.max_iter))
+
+    def run_shadow(self, request):
+        """
+        Runs a shadowing task on a fork of a warm speaker
+        :param request: Dictionary, see the /shadow request above
+        :return: Dictionary with the produced trajectory and the time it took (in seconds)
+        """
+        start = time.perf_counter()
+        speaker = self.speakers[request['speaker']].fork(np.random.default_rng(request.get('seed')))
+        i_token = Token(t_dims=request['token']['dims'].items(), t_label=request['token']['label'])
+        options = {key: request[key] for key in SHADOW_OPTIONS if key in request}
+
+        trajectory = shadow(speaker[request.get('cat', i_token.label)],
+                            speaker[request.get('reps', 'all')], i_token, **options)
+
+        return {'trajectory': [t.dimensions for t in trajectory],
+                'elapsed': time.perf_counter() - start}
+
+    def shutdown(self):
+        self.queue.shutdown()
+        for name in list(self.speakers):
+            self.remove_speaker(name)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # Set on the server class by serve()
+    service = None
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/speakers':
+            self.send_json(200, self.service.describe())
+        else:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        try:
+            request = self.read_json()
+            if not isinstance(request, dict):
+                raise ValueError('The request body has to be a JSON object')
+            if self.path == '/speakers':
+                self.service.submit(self.service.add_speaker, request['name'],
+                                    request.get('profile', request['name']), request.get('seed'))
+                self.send_json(200, self.service.describe()[request['name']])
+            elif self.path == '/shadow':
+                if request.get('speaker') not in self.service.speakers:
+                    self.send_json(404, {'error': 'Unknown speaker: ' + str(request.get('speaker'))})
+                    return
+                self.service.check_shadow(request)
+                self.send_json(200, self.service.submit(self.service.run_shadow, request))
+            else:
+                self.send_json(404, {'error': 'Unknown path: ' + self.path})
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': repr(e)})
+        except Exception as e:
+            # e.g. a simulation that failed, the server keeps serving
+            self.send_json(500, {'error': repr(e)})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host='127.0.0.1', port=8050, socket_path=None):
+    """
+    Serves requests until interrupted
+    :param service: The speakers to serve (class: SimulationService)
+    :param host: Host to listen on (HTTP)
+    :param port: Port to listen on (HTTP)
+    :param socket_path: If given, listens on this Unix socket instead of host and port
+    :return: None
+    """
+    handler = type('Handler', (RequestHandler,), {'service': service})
+    if socket_path is None:
+        server = ThreadingHTTPServer((host, port), handler)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local accommodation simulation server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--socket', default=None, help='Unix socket path (instead of host and port)')
+    parser.add_argument('--speakers', nargs='*', default=list(SPEAKER_PROFILES),
+                        help='Profiles to populate at startup')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-iter', type=int, default=MAX_ITER,
+                        help='Largest max_iter a /shadow request can ask for')
+    args = parser.parse_args()
+
+    service = SimulationService(args.max_iter)
+    for profile in args.speakers:
+        service.add_speaker(profile, profile, args.seed)
+    serve(service, args.host, args.port, args.socket)